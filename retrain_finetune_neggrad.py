@@ -1,16 +1,22 @@
 import hydra
 import torch
 import os
+import time
 from torch.optim import AdamW
-from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
 from src.utils import get_forgetting_subset
 import wandb
 from torch.utils.data import Subset
 from tqdm import tqdm
 
-from src.datasets.dataset import load_dataset
+from src.datasets.dataset import load_dataset, get_dataloader, ProgressiveResize, require_map_style
+from src.datasets.sampler import get_retain_sampler
 from src.models.classifier import Classifier
+from src.models.partial import SuffixModel, get_activation_dataset, get_feature_dataset
+from src.training import accumulate_gradients, enable_activation_checkpointing, evaluate
+from src.training import EarlyStopper, checkpoint_paths, save_training_state, load_training_state
+from src.device import setup_device, precision_autocast, precision_scaler, synchronize
+from src.distributed import launch, distribute, is_main_process, barrier
 from src.metrics.metrics import compute_metrics
 from src.loss.loss import NegGradLoss, NegGradPlusLoss, RandRelabelingLoss
 from src.log import get_loggers
@@ -18,27 +24,37 @@ from omegaconf import OmegaConf
 import multiprocessing
 
 
-@hydra.main(config_path='config', config_name='config', version_base=None)
-def main(cfg):
+def forward_loss(model, criterion, x, y, device):
+    y_pred = model(x.to(device))
+    return y_pred, criterion(y_pred, y.to(device))
+
+
+def run(cfg):
     # Set seed
     if cfg.seed == -1:
         random_data = os.urandom(4)
         seed = int.from_bytes(random_data, byteorder="big")
         cfg.seed = seed
     torch.manual_seed(cfg.seed)    
+    setup_device(cfg)
 
     wandb_logger = get_loggers(cfg) # loggers
 
     # Load dataset
     data_dir = os.path.join(cfg.currentDir, cfg.dataset.path)
-    train, val, test = load_dataset(cfg.dataset.name, data_dir, cfg.dataset.resize)
+    train, val, test = load_dataset(cfg.dataset.name, data_dir, cfg.dataset.resize, shared=cfg.dataset.shared_memory)
+    # the retain and forget samples are selected by index
+    require_map_style(train, 'The retrain script')
     img,lbl = train.__getitem__(0)
     print(img.shape, lbl)
     # retrieving forgetting set for filtering
     forgetting_set = get_forgetting_subset(cfg.forgetting_set, cfg.dataset.classes, cfg.forgetting_set_size)
+    full_train = train
 
-    model = Classifier(cfg.weights_name, num_classes=cfg[cfg.dataset.name].n_classes, finetune=True)
+    model = Classifier(cfg.weights_name, num_classes=cfg[cfg.dataset.name].n_classes, finetune=cfg.train.finetune)
     model.to(cfg.device)
+    if cfg.train.activation_checkpointing and not model.backbone_frozen():
+        enable_activation_checkpointing(model)
 
     optimizer = AdamW(model.parameters(), lr=cfg.train.lr)
     criterion = None    
@@ -46,26 +62,44 @@ def main(cfg):
     if cfg.unlearning_method == 'retrain' or cfg.unlearning_method == 'finetuning':
         criterion = torch.nn.CrossEntropyLoss()
         # Crea una lista di indici che non appartengono al forgetting_set
-        idx_train = [i for i, t in enumerate(train.targets) if t not in forgetting_set]
+        idx_train = train.class_index.retain_indices(forgetting_set)
         train = Subset(train, idx_train)
 
     if cfg.unlearning_method != 'retrain':
         weights = os.path.join(cfg.currentDir, cfg.train.save_path, cfg.dataset.name + '_' + cfg.model + '.pth')
         model.load_state_dict(torch.load(weights, map_location=cfg.device))
     if cfg.unlearning_method == 'neggrad' or cfg.unlearning_method == 'randomlabel':
-        idx_train = [i for i, t in enumerate(train.targets) if t in forgetting_set]
+        idx_train = train.class_index.forget_indices(forgetting_set)
         train = Subset(train, idx_train)
         if cfg.unlearning_method == 'neggrad':
             criterion = NegGradLoss()
         elif cfg.unlearning_method == 'randomlabel':
             criterion = RandRelabelingLoss(cfg[cfg.dataset.name].n_classes, forgetting_set)
+    sampler = None
     if cfg.unlearning_method == 'neggradplus':
         criterion = NegGradPlusLoss(forgetting_set)
+        sampler = get_retain_sampler(cfg, train.targets, train.class_index.forget_indices(forgetting_set))
+
+    train_model, eval_model = model, model
+    if model.backbone_frozen():
+        # only the head is trained, over the features of the frozen backbone extracted once per split: the features
+        # of the whole training set are shared by the heads of every forgetting set (e.g. golden retain-only heads)
+        features = get_feature_dataset(cfg, model, full_train, 'train')
+        train = Subset(features, train.indices) if isinstance(train, Subset) else features
+        val = get_feature_dataset(cfg, model, val, 'val')
+        test = get_feature_dataset(cfg, model, test, 'test')
+        train_model = eval_model = model.get_head()
+        optimizer = AdamW(train_model.parameters(), lr=cfg.train.lr)
+    elif cfg.unlearn.trainable_blocks is not None and cfg.unlearning_method != 'retrain':
+        # only the last blocks are trained, over the cached activations of the frozen prefix
+        train = get_activation_dataset(cfg, model, train, cfg.unlearning_method)
+        train_model = SuffixModel(model, cfg.unlearn.trainable_blocks)
+        optimizer = AdamW(train_model.parameters(), lr=cfg.train.lr)
 
     # dataloader of filtered dataset
-    train_loader = DataLoader(train, batch_size=cfg.train.batch_size, shuffle=True, num_workers=cfg.train.num_workers)
-    val_loader = DataLoader(val, batch_size=cfg.train.batch_size, shuffle=False, num_workers=cfg.train.num_workers)
-    test_loader = DataLoader(test, batch_size=cfg.train.batch_size, shuffle=False, num_workers=cfg.train.num_workers)
+    resize_schedule = ProgressiveResize(cfg, train, sampler)
+    val_loader = get_dataloader(cfg, val, distributed='eval')
+    test_loader = get_dataloader(cfg, test, distributed='eval')
     '''
     # TODO -> DELETE
     model.eval()
@@ -99,78 +133,98 @@ def main(cfg):
     '''
 
     # training    
-    for epoch in range(cfg.train.max_epochs):
+    precision = cfg.train.precision
+    scaler = precision_scaler(cfg.device, precision)
+    save_dir = os.path.join(cfg.currentDir, cfg.train.save_path)
+    os.makedirs(save_dir, exist_ok=True)
+    save_path = os.path.join(save_dir, f"{cfg.dataset.name}_forgetting_set_{str(cfg.forgetting_set)}_{cfg.unlearning_method}_{cfg.model}.pth")
+    best_path, last_path = checkpoint_paths(save_path)
+    stopper = EarlyStopper(cfg.train.monitor, cfg.train.patience)
+    start_epoch = 0
+    if cfg.train.resume and os.path.exists(last_path):
+        start_epoch = load_training_state(last_path, model, optimizer, scaler, stopper, cfg.device)
+    if cfg.train.early_stopping and stopper.stopped:
+        print(f"Training already stopped early, best {stopper.monitor} {stopper.best:.4f} at epoch {stopper.best_epoch+1}")
+        start_epoch = cfg.train.max_epochs
+
+    # data parallel over the ranks, if any, the evaluation runs on the unwrapped module
+    step_model = distribute(train_model)
+
+    for epoch in range(start_epoch, cfg.train.max_epochs):
         print(f"Epoch {epoch+1}/{cfg.train.max_epochs}")
-        model.train()
+        train_loader = resize_schedule.loader(epoch)
+        train_model.train()
         train_loss = 0
+        num_samples, time_start = 0, time.perf_counter()
         for x, y in tqdm(train_loader):
             optimizer.zero_grad()
-            x = x.to(cfg.device)
-            y = y.to(cfg.device)
-            y_pred = model(x)
-            loss = criterion(y_pred, y)
+            with precision_autocast(cfg.device, precision):
+                _, loss = accumulate_gradients(lambda x, y: forward_loss(step_model, criterion, x, y, cfg.device),
+                                               (x, y), cfg.train.microbatch_size, scaler, getattr(step_model, 'no_sync', None))
             train_loss += loss.item()
-            loss.backward()
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
+            num_samples += len(x)
+        synchronize(cfg.device)
+        throughput = num_samples / (time.perf_counter() - time_start)
+        print(f"Train throughput ({precision}): {throughput:.1f} samples/s")
 
         train_loss /= len(train_loader)
-        wandb_logger.log_metrics({"train_loss": train_loss})
+        wandb_logger.log_metrics({"train_loss": train_loss, "train_throughput": throughput})
+        if resize_schedule.enabled:
+            wandb_logger.log_metrics({"train_resize": resize_schedule.size(epoch)})
 
         # validation
-        model.eval()
-        with torch.no_grad():
-            val_loss, correct_ret, correct_for, total_ret, total_for = 0, 0, 0, 0, 0
-            for i, (x, y) in enumerate(tqdm(val_loader)):
-                x = x.to(cfg.device)
-                y = y.to(cfg.device)
-                y_pred = model(x)
-                loss = criterion(y_pred, y)
-                val_loss += loss.item()
-                _, predicted = y_pred.max(1)
-                for label, pred in zip(y, predicted):
-                    if label.item() in cfg.forgetting_set:
-                        total_for += 1
-                        correct_for += (label == pred).item()
-                    else:
-                        total_ret += 1
-                        correct_ret += (label == pred).item()
-
-            val_loss /= len(val_loader)
-            val_acc = 100 * (correct_ret + correct_for) / (total_ret + total_for)
-            wandb_logger.log_metrics({"val_loss": val_loss, "val_acc": val_acc})
-            retain_acc = 100 * correct_ret / total_ret if total_ret > 0 else 0
-            forget_acc = 100 * correct_for / total_for if total_for > 0 else 0
-            wandb_logger.log_metrics({"retain_val_acc": retain_acc, "forget_val_acc": forget_acc})
-    
-    model.eval()
-    # test
-    correct_ret, total_ret, correct_for, total_for = 0,0,0,0
-    for i, (x, y) in enumerate(tqdm(test_loader)):
-        x = x.to(cfg.device)
-        y = y.to(cfg.device)
-        y_pred = model(x)
-        _, predicted = y_pred.max(1)
+        val_loss, metrics = evaluate(eval_model, val_loader, criterion, cfg.dataset.classes, cfg.forgetting_set, cfg.device, precision)
+        val_acc = 100 * metrics['accuracy']
+        wandb_logger.log_metrics({"val_loss": val_loss, "val_acc": val_acc})
+        retain_acc = 100 * metrics['accuracy_retaining']
+        forget_acc = 100 * metrics['accuracy_forgetting']
+        wandb_logger.log_metrics({"retain_val_acc": retain_acc, "forget_val_acc": forget_acc})
+
+        # best weights for early stopping and resumable state of the last epoch
+        epoch_metrics = {"val_loss": val_loss, "val_acc": val_acc, "retain_val_acc": retain_acc, "forget_val_acc": forget_acc}
+        improved = stopper.step(epoch_metrics, epoch)
+        stopper.stopped = cfg.train.early_stopping and stopper.should_stop
+        if is_main_process():
+            if cfg.train.early_stopping and improved:
+                torch.save(model.state_dict(), best_path)
+            if cfg.train.resume:
+                save_training_state(last_path, epoch, model, optimizer, scaler, stopper)
+        barrier()
+        if stopper.stopped:
+            print(f"Early stopping at epoch {epoch+1}, best {stopper.monitor} {stopper.best:.4f} at epoch {stopper.best_epoch+1}")
+            break
+
+    # the best weights are missing if early stopping was only enabled when resuming
+    if cfg.train.early_stopping and stopper.best_epoch >= 0 and os.path.exists(best_path):
+        model.load_state_dict(torch.load(best_path, map_location=cfg.device))
+        wandb_logger.log_metrics({"best_epoch": stopper.best_epoch + 1})
 
-        for label, pred in zip(y, predicted):
-            if label.item() in cfg.forgetting_set:
-                # Forget classes
-                total_for += 1
-                correct_for += (label == pred).item()
-            else:
-                # Retain classes
-                total_ret += 1
-                correct_ret += (label == pred).item()
-    
-    # Compute averages
-    retain_acc = 100 * correct_ret / total_ret if total_ret > 0 else 0
-    forget_acc = 100 * correct_for / total_for if total_for > 0 else 0
+    # test
+    _, metrics = evaluate(eval_model, test_loader, criterion, cfg.dataset.classes, cfg.forgetting_set, cfg.device, precision)
+    retain_acc = 100 * metrics['accuracy_retaining']
+    forget_acc = 100 * metrics['accuracy_forgetting']
     wandb_logger.log_metrics({"retain_test_acc": retain_acc, "forget_test_acc": forget_acc})
 
+    if precision != 'fp32':
+        # accuracy parity of the reduced precision evaluation versus fp32
+        _, fp32_metrics = evaluate(eval_model, test_loader, criterion, cfg.dataset.classes, cfg.forgetting_set, cfg.device, 'fp32')
+        print(f"Test accuracy {precision}: {100 * metrics['accuracy']:.2f}%, fp32: {100 * fp32_metrics['accuracy']:.2f}%")
+        wandb_logger.log_metrics({"fp32_retain_test_acc": 100 * fp32_metrics['accuracy_retaining'],
+                                  "fp32_forget_test_acc": 100 * fp32_metrics['accuracy_forgetting'],
+                                  "precision_acc_gap": 100 * (metrics['accuracy'] - fp32_metrics['accuracy'])})
+
     # save unlearned model
-    os.makedirs(os.path.join(cfg.currentDir, cfg.train.save_path), exist_ok=True)
-    torch.save(model.state_dict(), os.path.join(cfg.currentDir, cfg.train.save_path, f"{cfg.dataset.name}_forgetting_set_{str(cfg.forgetting_set)}_{cfg.unlearning_method}_{cfg.model}.pth"))
+    if is_main_process():
+        torch.save(model.state_dict(), save_path)
     #metrics=compute_metrics(model, test_loader, cfg.dataset.classes, cfg.forgetting_set)
 
+
+@hydra.main(config_path='config', config_name='config', version_base=None)
+def main(cfg):
+    launch(run, cfg)
+
 if __name__ == '__main__':
     print('main')
     main()
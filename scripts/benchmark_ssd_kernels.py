@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import hydra
+import torch
+import torchvision
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.device import setup_device, synchronize
+from src.utils import FlatImportances, ssd_dampen_
+
+
+# Benchmark of the multi-tensor SSD kernels against the per-parameter loops they replace,
+# on a ResNet18 with random gradients.
+NUM_BATCHES = 50
+REPEATS = 10
+
+
+def reference_accumulate(model, importances):
+    for (_, p), imp in zip(model.named_parameters(), importances):
+        if p.grad is not None:
+            imp.data += p.grad.data.clone().pow(2)
+
+
+def reference_dampen(model, original, forget, selection_weighting, dampening_constant):
+    with torch.no_grad():
+        for p, oimp, fimp in zip(model.parameters(), original, forget):
+            locations = torch.where(fimp > oimp.mul(selection_weighting))
+            update = oimp.mul(dampening_constant).div(fimp)[locations]
+            update[torch.where(update > 1)] = 1
+            p[locations] = p[locations].mul(update)
+
+
+def timed(fn, device, repeats):
+    fn()  # warm up
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+@hydra.main(config_path='../config', config_name='config', version_base=None)
+def main(cfg):
+    device = setup_device(cfg)
+    torch.manual_seed(0)
+    model = torchvision.models.resnet18(num_classes=cfg.dataset.classes).to(device)
+    grads = [[torch.randn_like(p) * 1e-2 for p in model.parameters()] for _ in range(NUM_BATCHES)]
+    print(f'{sum(p.numel() for p in model.parameters())} parameters, {NUM_BATCHES} batches of gradients')
+
+    # importance accumulation
+    def run_reference():
+        importances = [torch.zeros_like(p) for p in model.parameters()]
+        for batch in grads:
+            for p, g in zip(model.parameters(), batch):
+                p.grad = g
+            reference_accumulate(model, importances)
+        return importances
+
+    def run_flat():
+        importances = FlatImportances(dict(model.named_parameters()))
+        for batch in grads:
+            for p, g in zip(model.parameters(), batch):
+                p.grad = g
+            importances.accumulate()
+        return importances
+
+    reference, flat = run_reference(), run_flat()
+    error = max((r - v).abs().max().item() for r, v in zip(reference, flat.views))
+    t_reference = timed(run_reference, device, REPEATS)
+    t_flat = timed(run_flat, device, REPEATS)
+    print(f'accumulation: loop {t_reference*1000:.2f} ms, foreach {t_flat*1000:.2f} ms, '
+          f'speedup {t_reference/t_flat:.2f}x, max abs error {error:.2e}')
+
+    # dampening, the forget importances are made larger than the original ones on part of the parameters
+    original = flat.flat.clone()
+    forget = original * torch.rand_like(original) * 20
+    original_list = [v.clone() for v in flat.views]
+    forget_list = [f.view_as(p) for f, p in zip(forget.split([p.numel() for p in model.parameters()]), model.parameters())]
+    weights = {k: v.clone() for k, v in model.state_dict().items()}
+
+    reference_dampen(model, original_list, forget_list, 10, 1)
+    expected = [p.detach().clone() for p in model.parameters()]
+    model.load_state_dict(weights)
+    ssd_dampen_(list(model.parameters()), original, forget, 10, 1)
+    error = max((e - p).abs().max().item() for e, p in zip(expected, model.parameters()))
+
+    def run_reference_dampen():
+        model.load_state_dict(weights)
+        reference_dampen(model, original_list, forget_list, 10, 1)
+
+    def run_flat_dampen():
+        model.load_state_dict(weights)
+        ssd_dampen_(list(model.parameters()), original, forget, 10, 1)
+
+    t_reference = timed(run_reference_dampen, device, REPEATS)
+    t_flat = timed(run_flat_dampen, device, REPEATS)
+    print(f'dampening: loop {t_reference*1000:.2f} ms, masked multiply {t_flat*1000:.2f} ms, '
+          f'speedup {t_reference/t_flat:.2f}x, max abs error {error:.2e}')
+
+
+if __name__ == '__main__':
+    main()
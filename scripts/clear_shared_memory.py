@@ -0,0 +1,22 @@
+import os
+import sys
+import hydra
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.datasets.shared import SHARED_DIR, remove_shared, shared_key
+
+
+# Remove the dataset splits published in shared memory by load_dataset(shared=True), which stay in RAM until reboot.
+# Removes the splits of cfg.dataset, or all of them with +clear_all=True.
+@hydra.main(config_path='../config', config_name='config', version_base=None)
+def main(cfg):
+    if cfg.get('clear_all', False):
+        remove_shared()
+        print(f'Removed all the shared splits in {SHARED_DIR}')
+    else:
+        key = shared_key(cfg.dataset.name, cfg.dataset.resize, seed=42)
+        remove_shared(key)
+        print(f'Removed {key} from {SHARED_DIR}')
+
+
+if __name__ == '__main__':
+    main()
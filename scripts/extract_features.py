@@ -9,7 +9,7 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from src.models.classifier import Classifier
 from torch.utils.data import DataLoader 
-from src.datasets.dataset import load_dataset
+from src.datasets.dataset import load_dataset, get_dataloader
 
 def extract_features(model, loader, device):
     model = model.to(device)
@@ -24,9 +24,7 @@ def extract_features(model, loader, device):
             features.append(batch_features)
             labels.append(batch_labels)
 
-            # Free gpu memory
             del images, batch_labels, batch_features
-            torch.cuda.empty_cache()
 
     # labels and features are lists of tensors, we concatenate them
     features = torch.cat(features, dim=0)
@@ -41,20 +39,9 @@ def main(cfg):
     train, val, test = load_dataset(cfg.dataset.name, data_dir, cfg.dataset.resize)
 
     # dataloader
-    train_loader = torch.utils.data.DataLoader(train, 
-        batch_size=cfg.train.batch_size, 
-        shuffle=False, 
-        num_workers=cfg.train.num_workers)
-    
-    val_loader = torch.utils.data.DataLoader(val, 
-        batch_size=cfg.train.batch_size, 
-        shuffle=False, 
-        num_workers=cfg.train.num_workers)
-
-    test_loader = torch.utils.data.DataLoader(test, 
-        batch_size=cfg.train.batch_size, 
-        shuffle=False, 
-        num_workers=cfg.train.num_workers)
+    train_loader = get_dataloader(cfg, train)
+    val_loader = get_dataloader(cfg, val)
+    test_loader = get_dataloader(cfg, test)
 
     model = Classifier(cfg.weights_name, num_classes=cfg.dataset.classes, finetune=True)
     if cfg.golden_model==True:
@@ -5,11 +5,10 @@ import torch
 import hydra
 import torchvision
 from datetime import datetime
-from torch.utils.data import DataLoader
 import os
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
-from src.datasets.dataset import load_dataset
+from src.datasets.dataset import load_dataset, get_dataloader
 from src.models.classifier import Classifier
 from scripts.descr_and_similarity import calculate_embeddings, calculate_dissimilarity
 from matplotlib.colors import TwoSlopeNorm
@@ -158,7 +157,7 @@ def main(cfg):
     elif cfg.dataset.name == 'lfw':
         _, _, test_dataset = load_dataset(cfg.dataset.name, data_dir, cfg.dataset.resize)
 
-    test_loader = DataLoader(test_dataset, batch_size=cfg.train.batch_size, shuffle=False, num_workers=cfg.train.num_workers)
+    test_loader = get_dataloader(cfg, test_dataset)
 
     # Load model
     model = Classifier(cfg.weights_name, num_classes=cfg.dataset.classes, finetune=True)
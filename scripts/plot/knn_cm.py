@@ -10,8 +10,9 @@ from sklearn.svm import LinearSVC
 import os
 import numpy as np
 
-from src.datasets.dataset import load_dataset
+from src.datasets.dataset import load_dataset, get_batch_transform
 from src.models.model import load_model
+from src.device import setup_device
 
 def knn(X_train, y_train, X_val, y_val, X_test, y_test, cfg):
 
@@ -110,11 +111,12 @@ def main(cfg):
     print(len(train), len(val), len(test))
 
     model_folder = 'checkpoints'
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    device = setup_device(cfg)
     model_orig = load_model('ResNet18_Weights.IMAGENET1K_V1', f'{model_folder}/cifar10_resnet.pth').to(device)
     model_345 = load_model('ResNet18_Weights.IMAGENET1K_V1', f'{model_folder}/cifar10_resnet_only_retain_set[3, 4, 5].pth').to(device)
 
     pred_orig,pred_345,test_labels_orig = [],[],[]
+    batch_transform = get_batch_transform(cfg)
 
     model_orig.eval()
     model_345.eval()
@@ -122,14 +124,13 @@ def main(cfg):
     with torch.no_grad():
         for j, (x, y) in enumerate(test):
             print(j)
-            x = x.unsqueeze(0).to(device)
+            x = batch_transform(x.unsqueeze(0)).to(device)
             y = torch.tensor(y).to(device)
             out_orig = model_orig(x)
             out_345 = model_345(x)
             pred_orig.append(out_orig.cpu().argmax(dim=1))
             pred_345.append(out_345.cpu().argmax(dim=1))
             test_labels_orig.append(y.cpu())
-            torch.cuda.empty_cache()
 
     pred_orig = torch.cat(pred_orig).numpy()
     pred_345 = torch.cat(pred_345).numpy()
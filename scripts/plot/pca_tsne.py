@@ -9,8 +9,9 @@ from datetime import datetime
 import os
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
-from src.datasets.dataset import load_dataset
+from src.datasets.dataset import load_dataset, get_dataloader
 from src.models.classifier import Classifier
+from src.device import resolve_device
 
 
 def plot_features_3d(cfg, model, data_loader, pca=None, unlearned=False): 
@@ -22,7 +23,7 @@ def plot_features_3d(cfg, model, data_loader, pca=None, unlearned=False):
     forgetting_subset = cfg.forgetting_set
 
     # Device setting
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = resolve_device(cfg.device)
     model.to(device)  
 
     with torch.no_grad():
@@ -116,7 +117,7 @@ def plot_features(cfg, model, data_loader, pca=None, unlearned=False, shared_lim
     forgetting_subset = cfg.forgetting_set
 
     # Device setting
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = resolve_device(cfg.device)
     model.to(device)  
 
     with torch.no_grad():
@@ -205,10 +206,7 @@ def main(cfg):
     _, _, test = load_dataset(cfg.dataset.name, data_dir, cfg.dataset.resize)
     
     # Data loaders
-    test_loader = torch.utils.data.DataLoader(test, 
-        batch_size=cfg.train.batch_size, 
-        shuffle=False, 
-        num_workers=cfg.train.num_workers)
+    test_loader = get_dataloader(cfg, test)
     model = Classifier(cfg.weights_name, num_classes=cfg[cfg.dataset.name].n_classes, finetune=True)
     model.to(cfg.device)
     weights = os.path.join(cfg.currentDir, cfg.train.save_path, cfg.dataset.name + '_' + cfg.model + '.pth')
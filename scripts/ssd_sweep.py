@@ -0,0 +1,82 @@
+import os
+import sys
+import csv
+import hydra
+import torch
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.models.classifier import Classifier
+from src.datasets.dataset import load_dataset, get_dataloader
+from src.datasets.unlearning_dataset import UnlearningDataset
+from src.metrics.metrics import compute_metrics
+from src.device import setup_device
+from src.utils import get_forgetting_subset, get_retain_and_forget_datasets, ParameterPerturber, cached_importances
+
+
+# Grid search of the SSD hyperparameters alpha (selection weighting) and lambda (dampening constant).
+# The forget and full set importances are computed once, then every grid point perturbs a fresh copy
+# of the original weights and is evaluated on the validation set.
+@hydra.main(config_path='../config', config_name='config', version_base=None)
+def main(cfg):
+    if cfg.seed == -1:
+        cfg.seed = int.from_bytes(os.urandom(4), byteorder="big")
+    torch.manual_seed(cfg.seed)
+    setup_device(cfg)
+
+    data_dir = os.path.join(cfg.currentDir, cfg.dataset.path)
+    train, val, _ = load_dataset(cfg.dataset.name, data_dir, cfg.dataset.resize, shared=cfg.dataset.shared_memory)
+    forgetting_subset = get_forgetting_subset(cfg.forgetting_set, cfg.dataset.classes, cfg.forgetting_set_size)
+
+    model = Classifier(cfg.weights_name, num_classes=cfg.dataset.classes, finetune=True)
+    weights = os.path.join(cfg.currentDir, cfg.train.save_path, cfg.dataset.name + '_' + cfg.model + '.pth')
+    model.load_state_dict(torch.load(weights, map_location=cfg.device))
+    model.to(cfg.device).eval()
+
+    _, forget_dataset, forget_indices = get_retain_and_forget_datasets(train, forgetting_subset, cfg.forgetting_set_size)
+    full_loader = get_dataloader(cfg, UnlearningDataset(train, forget_indices))
+    forget_loader = get_dataloader(cfg, forget_dataset)
+    val_loader = get_dataloader(cfg, val)
+
+    # importances, computed once for the whole grid
+    parameters = {"lower_bound": 1, "exponent": 1, "magnitude_diff": None,
+                  "min_layer": cfg.unlearn.ssd_min_layer, "max_layer": cfg.unlearn.ssd_max_layer,
+                  "module_paths": cfg.unlearn.ssd_module_paths,
+                  "forget_threshold": 1, "dampening_constant": None, "selection_weighting": None}
+    pdr = ParameterPerturber(model, torch.optim.SGD(model.parameters(), lr=0.001), cfg.device, parameters)
+    forget_importances = pdr.calc_importance(forget_loader, forget=True)
+    if cfg.unlearn.importance_cache.enabled:
+        cache_dir = os.path.join(cfg.currentDir, cfg.cache.path, 'ssd_importances')
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, f'{cfg.dataset.name}_resize{cfg.dataset.resize}')
+        full_importances = cached_importances(pdr, full_loader, cache_path, np.dtype(cfg.unlearn.importance_cache.dtype))
+    else:
+        full_importances = pdr.calc_importance(full_loader, forget=False)
+
+    original_weights = {k: v.clone() for k, v in model.state_dict().items()}
+    results = []
+    for alpha in cfg.ssd_sweep.alphas:
+        for dampening in cfg.ssd_sweep.lambdas:
+            model.load_state_dict(original_weights)
+            pdr.selection_weighting = alpha
+            pdr.dampening_constant = dampening
+            pdr.modify_weight(full_importances, forget_importances)
+            metrics = compute_metrics(model, val_loader, cfg.dataset.classes, forgetting_subset)
+            results.append((alpha, dampening, metrics['accuracy_retaining'], metrics['accuracy_forgetting']))
+            print(f'alpha: {alpha} lambda: {dampening} retain: {results[-1][2]*100:.2f}% forget: {results[-1][3]*100:.2f}%')
+
+    print(f'\n{"alpha":>8} {"lambda":>8} {"retain":>8} {"forget":>8}')
+    for alpha, dampening, retain, forget in results:
+        print(f'{alpha:>8} {dampening:>8} {retain*100:>7.2f}% {forget*100:>7.2f}%')
+
+    out_dir = os.path.join(cfg.currentDir, cfg.log.path)
+    os.makedirs(out_dir, exist_ok=True)
+    out_file = os.path.join(out_dir, f'ssd_sweep_{cfg.dataset.name}_{forgetting_subset}.csv')
+    with open(out_file, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['alpha', 'lambda', 'accuracy_retaining', 'accuracy_forgetting'])
+        writer.writerows(results)
+    print(f'Results saved in {out_file}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import torch
 from src.models.classifier import Classifier
 from src.models.model import load_model
+from src.device import resolve_device
 from matplotlib import pyplot as plt
 import numpy as np
 
@@ -13,7 +14,7 @@ def main():
     #model = Classifier('ResNet18_Weights.IMAGENET1K_V1', 10, finetune=True)
     
     model = load_model('ResNet18_Weights.IMAGENET1K_V1', f'{model_folder}/cifar10_resnet.pth')
-    model.to('cuda')
+    model.to(resolve_device('cuda'))
 
     (orig_distinct, orig_shared) = model.get_weights(10, [1,2])
     print(orig_distinct.shape, orig_shared.shape) # torch.Size([10, 513]) torch.Size([1024])
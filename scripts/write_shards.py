@@ -0,0 +1,39 @@
+import os
+import sys
+import hydra
+import numpy as np
+import torchvision
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.datasets.shards import write_shards
+
+
+# Pack an image folder dataset (<data>/<name>/<split>/<class>/<image>) into the sharded streaming format
+# read by load_dataset, written in <data>/<name>_shards/<split>.
+# If only the train split is available, val and test are sampled from it as in load_dataset.
+@hydra.main(config_path='../config', config_name='config', version_base=None)
+def main(cfg):
+    data_dir = os.path.join(cfg.currentDir, cfg.dataset.path)
+    source = os.path.join(data_dir, cfg.dataset.name)
+    out_dir = os.path.join(data_dir, f'{cfg.dataset.name}_shards')
+
+    splits = {}
+    for split in ['train', 'val', 'test']:
+        if os.path.isdir(os.path.join(source, split)):
+            splits[split] = torchvision.datasets.ImageFolder(os.path.join(source, split)).samples
+
+    if 'val' not in splits or 'test' not in splits:
+        samples = splits['train']
+        indices = np.random.RandomState(42).permutation(len(samples))
+        val_split = int(0.125 * len(samples))
+        test_split = int(0.125 * len(samples))
+        splits['val'] = [samples[i] for i in indices[:val_split]]
+        splits['test'] = [samples[i] for i in indices[val_split:val_split + test_split]]
+        splits['train'] = [samples[i] for i in indices[val_split + test_split:]]
+
+    for split, samples in splits.items():
+        print(f'{split}: {len(samples)} images')
+        write_shards(samples, os.path.join(out_dir, split), shard_size=cfg.shards.shard_size, quality=cfg.shards.quality)
+
+
+if __name__ == '__main__':
+    main()
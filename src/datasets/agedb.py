@@ -0,0 +1,132 @@
+import os
+import json
+import zipfile
+import numpy as np
+import torch
+from collections import defaultdict
+from src.datasets.shards import decode_image
+
+
+def _parse_filename(file):
+    # AgeDB file names are <id>_<name>_<age>_<gender>.jpg
+    parts = os.path.splitext(os.path.basename(file))[0].split("_")
+    if len(parts) < 4:
+        return None
+    _, name, age, gender = parts[:4]
+    # malformed ages do not discard the sample, as in the original loader which did not parse them
+    age = int(age) if age.isdigit() else None
+    return name.lower(), age, gender.lower()
+
+
+def _list_images(source):
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source, 'r') as zip_ref:
+            files = [f for f in zip_ref.namelist() if f.endswith(".jpg")]
+    else:
+        files = []
+        for root, _, names in os.walk(source):
+            files.extend(os.path.relpath(os.path.join(root, f), source) for f in names if f.endswith(".jpg"))
+    # sorted, so that class ids and splits do not depend on the file system order; they differ from the ones of the
+    # original os.listdir based loader, AgeDB checkpoints trained before have to be retrained
+    return sorted(files)
+
+
+def build_agedb_manifest(source, min_samples=41):
+    """
+    Build the AgeDB manifest without decoding any image.
+    Args:
+        source (str): path of AgeDB.zip or of the extracted folder.
+        min_samples (int): classes with less samples are discarded.
+    Returns:
+        manifest (dict): file names, class ids, ages and genders of the valid samples.
+    """
+    entries = []
+    class_counts = defaultdict(int)
+    for file in _list_images(source):
+        parsed = _parse_filename(file)
+        if parsed is None:
+            continue
+        entries.append((file, *parsed))
+        class_counts[parsed[0]] += 1
+
+    name_to_id = {}
+    manifest = {"files": [], "labels": [], "ages": [], "genders": [], "classes": []}
+    for file, name, age, gender in entries:
+        if class_counts[name] < min_samples:
+            continue
+        if name not in name_to_id:
+            name_to_id[name] = len(name_to_id)
+            manifest["classes"].append(name)
+        manifest["files"].append(file)
+        manifest["labels"].append(name_to_id[name])
+        manifest["ages"].append(age)
+        manifest["genders"].append(gender)
+    return manifest
+
+
+def load_agedb_manifest(source, min_samples=41):
+    """Load the manifest cached next to the source, rebuilding it if the source changed."""
+    stat = os.stat(source)
+    key = {"source": os.path.abspath(source), "size": stat.st_size, "mtime": stat.st_mtime, "min_samples": min_samples}
+    manifest_path = os.path.normpath(source).rstrip(os.sep) + "_manifest.json"
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as file:
+            cached = json.load(file)
+        if cached["key"] == key:
+            return cached["manifest"]
+
+    manifest = build_agedb_manifest(source, min_samples)
+    with open(manifest_path + ".tmp", "w") as file:
+        json.dump({"key": key, "manifest": manifest}, file)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    print(f"AgeDB manifest: {len(manifest['files'])} images of {len(manifest['classes'])} classes")
+    return manifest
+
+
+class AgeDBDataset(torch.utils.data.Dataset):
+    def __init__(self, source, resize=224, min_samples=41):
+        """
+        AgeDBDataset class, images are decoded lazily from the zip file or the extracted folder.
+        Args:
+            source (str): path of AgeDB.zip or of the extracted folder.
+            resize (int): side of the returned uint8 images.
+            min_samples (int): classes with less samples are discarded.
+        """
+        self.source = source
+        self.resize = resize
+        self.manifest = load_agedb_manifest(source, min_samples)
+        self.files = self.manifest["files"]
+        self.labels = np.asarray(self.manifest["labels"], dtype=np.int64)
+        self.is_zip = zipfile.is_zipfile(source)
+        self._zip = None
+        self._zip_pid = None
+
+    def __len__(self):
+        return len(self.files)
+
+    def _read(self, file):
+        if not self.is_zip:
+            with open(os.path.join(self.source, file), 'rb') as f:
+                return f.read()
+        # zip handles cannot be shared among DataLoader workers, each process opens its own
+        if self._zip is None or self._zip_pid != os.getpid():
+            self._zip = zipfile.ZipFile(self.source, 'r')
+            self._zip_pid = os.getpid()
+        return self._zip.read(file)
+
+    def __getitem__(self, idx):
+        img = decode_image(self._read(self.files[idx]), self.resize)
+        return img, int(self.labels[idx])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_zip"] = None
+        return state
+
+
+def get_agedb_source(data_dir):
+    # prefer a previously extracted folder, fall back to the zip file
+    extracted = os.path.join(data_dir, "AgeDB", "AgeDB")
+    if os.path.isdir(extracted):
+        return extracted
+    return os.path.join(data_dir, "AgeDB.zip")
@@ -1,39 +1,99 @@
 import torch
 import torchvision
-from sklearn.datasets import fetch_lfw_people
 import numpy as np
 from torchvision import transforms
 import os
-import sys
 import math
-from collections import defaultdict
+import time
+import functools
+import hashlib
 from torch.utils.data import Dataset, Subset
 from torch.utils.data import DataLoader
-from scripts.parse_agedb_dataset import retrieve_AgeDB_dataset
+from torch.utils.data.dataloader import default_collate
+from src.datasets.agedb import AgeDBDataset, get_agedb_source
+from src.datasets.lfw import load_lfw_splits
+from src.datasets.shards import ShardedDataset
+from src.datasets.shared import attach_or_publish, shared_key
+from src.datasets.sampler import get_retain_sampler, RankPartitionSampler, ShardSampler
+from src.distributed import get_rank, get_world_size
 
 
 class ImgTextDataset(torch.utils.data.Dataset):
     def __init__(self, orig_dataset, transform=None):
         self.orig_dataset = orig_dataset
         self.transform = transform
-        self.targets = [lbl for _, lbl in orig_dataset]
+        self.targets = get_targets(orig_dataset)  # read from the source, no image is decoded
+        self._class_index = None
 
     def __len__(self):
         return self.orig_dataset.__len__()
 
     def __getitem__(self, idx):
+        # images are returned as uint8 tensors, clamping, channel expansion and resize are done by BatchTransform
         img, lbl = self.orig_dataset.__getitem__(idx)
-        img = torch.clamp(img, 0, 1) # clamp the image to be between 0 and 1
-        # clip image to be three channels
-        if img.shape[0] == 1:
-            img = img.repeat(3, 1, 1)
         if self.transform:
             img = self.transform(img)
 
         return img, lbl
 
-class LfwDataset(torch.utils.data.Dataset):
+    @property
+    def class_index(self):
+        if self._class_index is None:
+            self._class_index = ClassIndex(self.targets)
+        return self._class_index
+
+
+class ClassIndex:
+    def __init__(self, targets, num_classes=None):
+        """
+        Class to indices index in CSR format: the indices of class c are indices[offsets[c]:offsets[c+1]].
+        Args:
+            targets (np.ndarray): label of each sample.
+            num_classes (int): number of classes, inferred from the targets if None.
+        """
+        self.targets = np.asarray(targets, dtype=np.int64)
+        self.num_classes = int(self.targets.max()) + 1 if num_classes is None else num_classes
+        self.indices = np.argsort(self.targets, kind='stable')
+        counts = np.bincount(self.targets, minlength=self.num_classes)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def class_mask(self, classes):
+        classes = np.asarray(list(classes), dtype=np.int64)
+        mask = np.zeros(self.num_classes, dtype=bool)
+        mask[classes[classes < self.num_classes]] = True
+        return mask
+
+    def forget_indices(self, classes):
+        """Sorted indices of the samples of the given classes, gathered from the CSR rows."""
+        classes = np.flatnonzero(self.class_mask(classes))
+        starts = self.offsets[classes]
+        counts = self.offsets[classes + 1] - starts
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return np.sort(self.indices[positions])
+
+    def retain_indices(self, classes):
+        """Sorted indices of the samples not belonging to the given classes."""
+        return np.flatnonzero(~self.class_mask(classes)[self.targets])
+
+    def split(self, classes):
+        return self.retain_indices(classes), self.forget_indices(classes)
+
+
+def get_class_index(dataset):
+    # datasets returned by load_dataset keep their index, the others (e.g. Subsets) get a new one
+    if isinstance(dataset, ImgTextDataset):
+        return dataset.class_index
+    return ClassIndex(get_targets(dataset))
+
+
+class ArrayDataset(torch.utils.data.Dataset):
     def __init__(self, images, labels):
+        """
+        ArrayDataset class.
+        Args:
+            images (Tensor or np.ndarray): uint8 images with shape [N, C, H, W], possibly memory-mapped.
+            labels (Tensor or np.ndarray): labels with shape [N].
+        """
         self.images = images
         self.labels = labels
 
@@ -41,25 +101,145 @@ class LfwDataset(torch.utils.data.Dataset):
         return len(self.images)
 
     def __getitem__(self, idx):
-        return self.images[idx], self.labels[idx]
-
-
-def load_dataset(dataset, data_dir, resize=224, val_split=0.125, test_split=0.125):
+        img = self.images[idx]
+        if isinstance(img, np.ndarray):
+            img = torch.from_numpy(np.array(img))
+        return img, int(self.labels[idx])
+
+
+class BatchTransform:
+    def __init__(self, resize=None, channels_last=False, dtype=torch.float32, device=None):
+        """
+        Vectorized transform applied to a whole collated batch instead of single samples.
+        Args:
+            resize (int): output side of the images, None keeps the native resolution.
+            channels_last (bool): return the batch in channels_last memory format.
+            dtype (torch.dtype): dtype of the returned batch.
+            device (str): if set, the uint8 batch is moved to this device before being converted.
+        """
+        self.resize = resize
+        self.channels_last = channels_last
+        self.dtype = dtype
+        self.device = device
+
+    def __call__(self, images):
+        if self.device is not None:
+            images = images.to(self.device, non_blocking=True)
+        if images.dtype == torch.uint8:
+            images = images.to(torch.float32).div_(255)
+        else:
+            images = images.to(torch.float32)
+        if self.resize is not None and tuple(images.shape[-2:]) != (self.resize, self.resize):
+            images = torch.nn.functional.interpolate(images, size=(self.resize, self.resize), mode='bilinear', align_corners=False)
+        images = images.clamp_(0, 1) # clamp the images to be between 0 and 1
+        # expand grayscale images to three channels
+        if images.shape[1] == 1:
+            images = images.expand(-1, 3, -1, -1)
+        if self.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        return images.to(self.dtype)
+
+
+class TransformDataLoader(DataLoader):
+    """DataLoader applying a BatchTransform to the images of every collated batch, in the main process."""
+    def __init__(self, dataset, batch_transform=None, **kwargs):
+        # streaming datasets shuffle by themselves
+        if isinstance(dataset, torch.utils.data.IterableDataset) and kwargs.pop('shuffle', False):
+            dataset.shuffle = True
+        super().__init__(dataset, **kwargs)
+        self.batch_transform = batch_transform
+        self.epoch = 0
+
+    def __iter__(self):
+        if hasattr(self.dataset, 'set_epoch'):
+            self.dataset.set_epoch(self.epoch)
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(self.epoch)
+        self.epoch += 1
+        for batch in super().__iter__():
+            yield self._apply_transform(batch)
+
+    def _apply_transform(self, batch):
+        if self.batch_transform is None:
+            return batch
+        if isinstance(batch, (list, tuple)):
+            return [self.batch_transform(batch[0]), *batch[1:]]
+        return self.batch_transform(batch)
+
+
+def get_targets(dataset):
+    """
+    Labels of a dataset as a numpy array, read from the underlying source without decoding images.
+    Args:
+        dataset (Dataset): ArrayDataset, AgeDBDataset, torchvision dataset or (nested) Subset of them.
+    Returns:
+        targets (np.ndarray): label of each sample.
+    """
+    if isinstance(dataset, Subset):
+        return get_targets(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    if isinstance(dataset, ImgTextDataset):
+        return dataset.targets
+    if hasattr(dataset, 'labels'):
+        return np.asarray(dataset.labels, dtype=np.int64)
+    if hasattr(dataset, 'targets'):
+        return np.asarray(dataset.targets, dtype=np.int64)
+    # unknown source, fall back to reading every sample
+    return np.asarray([lbl for _, lbl in dataset], dtype=np.int64)
+
+
+def dataset_fingerprint(dataset):
+    """Hash identifying the samples of a dataset: source type and size, and indices of the samples in the source."""
+    indices = np.arange(len(dataset))
+    while True:
+        if isinstance(dataset, Subset):
+            indices = np.asarray(dataset.indices, dtype=np.int64)[indices]
+            dataset = dataset.dataset
+        elif isinstance(dataset, ImgTextDataset):
+            dataset = dataset.orig_dataset
+        elif hasattr(dataset, 'dataset'):
+            # wrappers preserving the indexing, e.g. UnlearningDataset
+            dataset = dataset.dataset
+        else:
+            break
+    h = hashlib.sha1(f'{type(dataset).__name__}_{len(dataset)}'.encode())
+    h.update(indices.astype(np.int64).tobytes())
+    return h.hexdigest()[:16]
+
+
+def require_map_style(dataset, what):
+    """Raise a clear error for streaming (sharded) datasets where samples must be indexed."""
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        raise ValueError(f"{what} needs indexable datasets, sharded datasets ({type(dataset).__name__}) can only be "
+                         f"streamed: use them with train.py, or convert the dataset to a map-style format")
+
+
+def get_batch_transform(cfg, device=None):
+    # LFW images are used at the resolution returned by fetch_lfw_people
+    resize = None if cfg.dataset.name == 'lfw' else cfg.dataset.resize
+    return BatchTransform(resize, channels_last=cfg.dataset.channels_last, device=device)
+
+
+def load_dataset(dataset, data_dir, resize=224, val_split=0.125, test_split=0.125, shared=False):
 
     train, val, test = None, None, None
 
+    # the splits are built by the first process and then shared through shared memory (not for streaming datasets)
+    if shared and not os.path.isdir(os.path.join(data_dir, f'{dataset}_shards')):
+        build = lambda: {name: _split_arrays(split) for name, split in
+                         zip(['train', 'val', 'test'], load_dataset(dataset, data_dir, resize, val_split, test_split))}
+        splits = attach_or_publish(shared_key(dataset, resize, seed=42), build)
+        return tuple(ImgTextDataset(ArrayDataset(*splits[name])) for name in ['train', 'val', 'test'])
+
     torch.manual_seed(42)
     np.random.seed(42)
 
-    transform = torchvision.transforms.Compose([
-        torchvision.transforms.ToTensor(),
-        torchvision.transforms.Resize((resize, resize)),
-    ])
+    # images are kept as uint8 tensors at their native resolution and resized batch-wise by BatchTransform,
+    # only AgeDB images, whose size is not fixed, are resized while being decoded
 
     # CIFAR-10
     if dataset == 'cifar10':
-        train = torchvision.datasets.CIFAR10(data_dir, train=True, download=True, transform=transform)
-        test = torchvision.datasets.CIFAR10(data_dir, train=False, download=True, transform=transform)
+        train = _cifar_to_array(torchvision.datasets.CIFAR10(data_dir, train=True, download=True))
+        test = _cifar_to_array(torchvision.datasets.CIFAR10(data_dir, train=False, download=True))
 
         split = int(len(train) * val_split)
         train, val = torch.utils.data.random_split(train, [len(train) - split, split])
@@ -67,101 +247,24 @@ def load_dataset(dataset, data_dir, resize=224, val_split=0.125, test_split=0.12
 
     # CIFAR-100
     elif dataset == 'cifar100':
-        train = torchvision.datasets.CIFAR100(data_dir, train=True, download=True, transform=transform)
-        test = torchvision.datasets.CIFAR100(data_dir, train=False, download=True, transform=transform)
+        train = _cifar_to_array(torchvision.datasets.CIFAR100(data_dir, train=True, download=True))
+        test = _cifar_to_array(torchvision.datasets.CIFAR100(data_dir, train=False, download=True))
 
         split = int(len(train) * val_split)
         train, val = torch.utils.data.random_split(train, [len(train) - split, split])
     
     # LFW dataset
     elif dataset == 'lfw':
-        data = fetch_lfw_people(
-            color=True,
-            resize=resize / 256,  # set resolution
-            min_faces_per_person=11  # Take only people with at least 20 images
-        )
-
-        images = torch.tensor(data.images).permute(0, 3, 1, 2).float()  # Convert to tensor and permute dimensions
-        labels = torch.tensor(data.target)
-
-        class_dict = defaultdict(list)
-        for img, lbl in zip(images, labels):
-            class_dict[lbl.item()].append(img)
-        print(f'Number of classes: {len(class_dict)}')
-
-        # Initialize lists for train, val and test images and labels
-        train_images, val_images, test_images = [], [], []
-        train_labels, val_labels, test_labels = [], [], []
-
-        # Distribute the images in train, val and test
-        for lbl, imgs in class_dict.items():
-            np.random.shuffle(imgs)  
-
-            train_images.append(imgs[0])
-            train_images.append(imgs[1])
-            train_images.append(imgs[2])
-            train_images.append(imgs[3])
-            val_images.append(imgs[4])
-            test_images.append(imgs[5])
-
-            train_labels.append(lbl)
-            train_labels.append(lbl)
-            train_labels.append(lbl)
-            train_labels.append(lbl)
-            val_labels.append(lbl)
-            test_labels.append(lbl)
-
-            # Distribute the remaining images in train, val and test
-            remaining = imgs[6:]
-            for i, img in enumerate(remaining):
-                if len(train_images) <= 2*len(val_images) and len(train_images) <= 2*len(test_images):
-                    train_images.append(img)
-                    train_labels.append(lbl)
-                elif len(val_images) <= len(test_images):
-                    val_images.append(img)
-                    val_labels.append(lbl)
-                else:
-                    test_images.append(img)
-                    test_labels.append(lbl)
-
-        # Convert images to tensor
-        train_images = torch.stack(train_images)
-        val_images = torch.stack(val_images)
-        test_images = torch.stack(test_images)
-
-        # convert labels to tensor
-        train_labels = torch.tensor(train_labels)
-        val_labels = torch.tensor(val_labels)
-        test_labels = torch.tensor(test_labels)
-
-        # verify the number of classes in train, val and test
-        unique_train = torch.unique(train_labels)
-        unique_val = torch.unique(val_labels)
-        unique_test = torch.unique(test_labels)
-
-
-        train = LfwDataset(train_images, train_labels)
-        val = LfwDataset(val_images, val_labels)
-        test = LfwDataset(test_images, test_labels)
+        # the splits are cached in memory-mapped uint8 arrays
+        splits = load_lfw_splits(data_dir, resize, min_faces_per_person=11)
+        train = ArrayDataset(*splits['train'])
+        val = ArrayDataset(*splits['val'])
+        test = ArrayDataset(*splits['test'])
 
     elif dataset == 'ageDB':
-        class AgeDBDataset(torch.utils.data.Dataset):
-            def __init__(self, dataset, transform=None):
-                self.dataset = dataset
-                self.transform = transform
-
-            def __len__(self):
-                return len(self.dataset)
-
-            def __getitem__(self, idx):
-                img, lbl = self.dataset[idx]
-                if self.transform:
-                    img = self.transform(img)
-                return img, lbl
-        sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
-        os.chdir(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
-        dataset = retrieve_AgeDB_dataset("data/AgeDB.zip", "data/AgeDB/AgeDB")
-        
+        # images are decoded lazily, only the manifest is read here
+        dataset = AgeDBDataset(get_agedb_source(data_dir), resize)
+
         # sample the dataset
         num_samples = len(dataset)
         indices = list(range(num_samples))
@@ -180,13 +283,15 @@ def load_dataset(dataset, data_dir, resize=224, val_split=0.125, test_split=0.12
         train = torch.utils.data.Subset(dataset, train_indices)
         val = torch.utils.data.Subset(dataset, val_indices)
         test = torch.utils.data.Subset(dataset, test_indices)
-        
 
-        # Apply the transform
-        if transform:
-            train = AgeDBDataset(train, transform)
-            val = AgeDBDataset(val, transform)
-            test = AgeDBDataset(test, transform)
+    # datasets converted with scripts/write_shards.py (e.g. imagenet, caltech101, oxford-iiit-pet, oxford-flowers)
+    elif os.path.isdir(os.path.join(data_dir, f'{dataset}_shards')):
+        # streaming datasets are returned as they are, they already yield uint8 images and expose their targets
+        root = os.path.join(data_dir, f'{dataset}_shards')
+        train = ShardedDataset(os.path.join(root, 'train'), resize)
+        val = ShardedDataset(os.path.join(root, 'val'), resize)
+        test = ShardedDataset(os.path.join(root, 'test'), resize)
+        return train, val, test
 
     else:
         raise ValueError(f'Unknown dataset: {dataset}')
@@ -198,16 +303,217 @@ def load_dataset(dataset, data_dir, resize=224, val_split=0.125, test_split=0.12
     return train, val, test
 
 
-def get_retain_forget_dataloaders(cfg, retain_dataset, forget_dataset):
+def _cifar_to_array(cifar):
+    images = torch.from_numpy(cifar.data).permute(0, 3, 1, 2).contiguous()  # [N, H, W, C] -> [N, C, H, W]
+    return ArrayDataset(images, torch.tensor(cifar.targets))
+
+
+def _split_arrays(dataset):
+    # uint8 images and labels of a split, gathered from the source arrays when possible
+    labels = get_targets(dataset)
+    source, indices = dataset.orig_dataset, np.arange(len(dataset))
+    while isinstance(source, Subset):
+        indices = np.asarray(source.indices, dtype=np.int64)[indices]
+        source = source.dataset
+    if isinstance(source, ArrayDataset):
+        images = np.asarray(source.images)[indices]
+    else:
+        images = np.stack([np.asarray(dataset[i][0]) for i in range(len(dataset))])
+    return images, labels
+
+
+def fast_collate(batch):
+    """Collate (uint8 image, int, ...) samples with a single stack, falling back to default_collate."""
+    first = batch[0]
+    if not (isinstance(first[0], torch.Tensor) and first[0].dtype == torch.uint8
+            and all(isinstance(x, (int, np.integer)) for x in first[1:])):
+        return default_collate(batch)
+    images = [sample[0] for sample in batch]
+    out = None
+    if torch.utils.data.get_worker_info() is not None:
+        # allocate directly in shared memory, as default_collate does, to avoid a copy when sending the batch
+        elem = images[0]
+        storage = elem._typed_storage()._new_shared(len(images) * elem.numel(), device=elem.device)
+        out = elem.new(storage).resize_(len(images), *elem.shape)
+    collated = [torch.stack(images, 0, out=out)]
+    collated.extend(torch.tensor([int(sample[i]) for sample in batch]) for i in range(1, len(first)))
+    return collated
+
+
+def _worker_init(worker_id, affinity):
+    # workers only decode and collate, they do not need intra-op parallelism
+    torch.set_num_threads(1)
+    if affinity and hasattr(os, 'sched_getaffinity'):
+        # pin workers to the last cores, leaving the first ones to the main process
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cores[-1 - worker_id % len(cores)]})
+
+
+_autotuned = {}
+
+def autotune_loader(dataset, batch_size, settings, num_batches=20):
+    """
+    Measure the throughput (samples/s) of a few loader settings and return the fastest one.
+    Results are kept for the whole process, keyed by dataset type, dataset size and batch size.
+    """
+    key = (type(dataset).__name__, len(dataset), batch_size)
+    if key in _autotuned:
+        return _autotuned[key]
+
+    best, best_throughput = settings[0], 0.0
+    for setting in settings:
+        loader = DataLoader(dataset, batch_size=batch_size, collate_fn=fast_collate, **setting)
+        iterator = iter(loader)
+        start, samples = None, 0
+        for i, batch in enumerate(iterator):
+            if i == 0:
+                start = time.perf_counter()  # skip the workers start-up
+                continue
+            samples += len(batch[0])
+            if i == num_batches:
+                break
+        throughput = samples / (time.perf_counter() - start) if samples > 0 else 0.0
+        del iterator, loader
+        print(f'Loader autotune {setting}: {throughput:.1f} samples/s')
+        if throughput > best_throughput:
+            best, best_throughput = setting, throughput
+    _autotuned[key] = best
+    return best
+
+
+def _loader_settings(num_workers, cfg):
+    setting = {'num_workers': num_workers, 'pin_memory': cfg.dataloader.pin_memory}
+    if num_workers > 0:
+        setting['persistent_workers'] = cfg.dataloader.persistent_workers
+        setting['prefetch_factor'] = cfg.dataloader.prefetch_factor
+        setting['worker_init_fn'] = functools.partial(_worker_init, affinity=cfg.dataloader.worker_affinity)
+    return setting
+
+
+def _is_precomputed(dataset):
+    # datasets of cached activations (or wrappers of them) are not images, the batch transform is skipped
+    while dataset is not None:
+        if getattr(dataset, 'precomputed', False):
+            return True
+        dataset = getattr(dataset, 'dataset', None)
+    return False
+
+
+def _distributed_sampler(cfg, dataset, shuffle, sampler, drop_last, distributed):
+    # share of the samples of the current rank
+    num_replicas, rank = get_world_size(), get_rank()
+    if distributed == 'eval':
+        return ShardSampler(len(dataset), num_replicas, rank)
+    if distributed != 'train':
+        raise ValueError(f"Distributed mode '{distributed}' not recognised, use train or eval")
+    if sampler is not None:
+        return RankPartitionSampler(sampler, num_replicas, rank)
+    seed = cfg.seed if cfg.seed >= 0 else 0
+    return torch.utils.data.DistributedSampler(dataset, num_replicas, rank, shuffle=shuffle, seed=seed, drop_last=drop_last)
+
+
+def get_dataloader(cfg, dataset, batch_size=None, shuffle=False, sampler=None, drop_last=False, distributed=None):
+    """
+    Build a DataLoader with the settings of cfg.dataloader, the uint8 batches are converted by BatchTransform.
+    Args:
+        cfg (DictConfig): hydra config.
+        dataset (Dataset): dataset returned by load_dataset, or a subset/wrapper of it.
+        batch_size (int): batch size, cfg.train.batch_size if None.
+        shuffle (bool): shuffle the samples every epoch.
+        sampler (Sampler): custom sampler, mutually exclusive with shuffle.
+        drop_last (bool): drop the last incomplete batch.
+        distributed (str): when running in several processes, 'train' gives every rank an equally long share of the
+            samples (so that all the ranks run the same number of steps), 'eval' a disjoint share to be reduced over
+            the ranks. None iterates the whole dataset on every rank, e.g. to build caches.
+    """
+    batch_size = cfg.train.batch_size if batch_size is None else batch_size
+    if distributed is not None and get_world_size() > 1:
+        if not isinstance(dataset, torch.utils.data.IterableDataset):
+            sampler, shuffle = _distributed_sampler(cfg, dataset, shuffle, sampler, drop_last, distributed), False
+        elif distributed == 'train':
+            # streaming datasets split whole shards between the ranks, which may then run a different number of
+            # steps and hang in the gradient all-reduce
+            raise ValueError("Data-parallel training is not supported for streaming datasets")
+    setting = _loader_settings(cfg.dataloader.num_workers, cfg)
+    if cfg.dataloader.autotune and not isinstance(dataset, torch.utils.data.IterableDataset):
+        max_workers = min(os.cpu_count() or 1, 16)
+        candidates = sorted({0, 2, 4, 8, max_workers} & set(range(max_workers + 1)))
+        settings = [_loader_settings(n, cfg) for n in candidates]
+        settings += [dict(_loader_settings(n, cfg), prefetch_factor=4) for n in candidates if n > 0]
+        setting = autotune_loader(dataset, batch_size, settings)
+
+    batch_transform = None if _is_precomputed(dataset) else get_batch_transform(cfg)
+    return TransformDataLoader(dataset, batch_transform, batch_size=batch_size, shuffle=shuffle,
+                               sampler=sampler, drop_last=drop_last, collate_fn=fast_collate, **setting)
+
+
+class ProgressiveResize:
+    def __init__(self, cfg, dataset, sampler=None, multiple=16):
+        """
+        Training loaders of a progressive resizing schedule, see cfg.train.progressive_resize: the images are resized
+        by the BatchTransform to a side growing linearly from start_size to cfg.dataset.resize over ramp_epochs epochs.
+        With scale_batch_size, the batch size grows as the number of pixels shrinks, keeping the memory constant.
+        Args:
+            cfg (DictConfig): hydra config.
+            dataset (Dataset): training dataset.
+            sampler (Sampler): custom sampler, the dataset is shuffled if None.
+            multiple (int): the sides are rounded to a multiple of it.
+        """
+        settings = cfg.train.progressive_resize
+        self.cfg = cfg
+        self.dataset = dataset
+        self.sampler = sampler
+        self.final_size = get_batch_transform(cfg).resize
+        self.start_size = settings.start_size
+        self.ramp_epochs = settings.ramp_epochs
+        self.scale_batch_size = settings.scale_batch_size
+        self.multiple = multiple
+        self.enabled = settings.enabled and self.final_size is not None and not _is_precomputed(dataset)
+        if settings.enabled and not self.enabled:
+            print("Progressive resizing needs resized images, training at the final resolution")
+        self._loaders = {}
+
+    def size(self, epoch):
+        if not self.enabled or epoch >= self.ramp_epochs:
+            return self.final_size
+        size = self.start_size + (self.final_size - self.start_size) * epoch / self.ramp_epochs
+        return min(max(self.multiple, int(round(size / self.multiple)) * self.multiple), self.final_size)
+
+    def batch_size(self, epoch):
+        batch_size = self.cfg.train.batch_size
+        if not self.scale_batch_size or not self.enabled:
+            return batch_size
+        return int(batch_size * (self.final_size / self.size(epoch)) ** 2)
+
+    def loader(self, epoch):
+        """Training loader of an epoch, the loaders are built once per batch size."""
+        batch_size = self.batch_size(epoch)
+        if batch_size not in self._loaders:
+            self._loaders[batch_size] = get_dataloader(self.cfg, self.dataset, batch_size, shuffle=self.sampler is None,
+                                                       sampler=self.sampler, distributed='train')
+        loader = self._loaders[batch_size]
+        loader.epoch = epoch
+        if loader.batch_transform is not None:
+            loader.batch_transform.resize = self.size(epoch)
+        return loader
+
+
+def get_retain_forget_dataloaders(cfg, retain_dataset, forget_dataset, distributed='train'):
+    # SSD passes distributed=None: its importances are not reduced over the ranks, every rank reads the whole sets
     if cfg.unlearning_method == 'scrub' or cfg.unlearning_method == 'ssd':
+        # Scrub can draw only a subset of the retain set every epoch
+        sampler = get_retain_sampler(cfg, get_targets(retain_dataset), []) if cfg.unlearning_method == 'scrub' else None
         # need to balance number of steps, so need to have different batch sizes
-        retain_batch_size = math.ceil(cfg.train.batch_size * (cfg.dataset.classes - cfg.forgetting_set_size) / cfg.forgetting_set_size)
+        if sampler is not None:
+            retain_batch_size = math.ceil(cfg.train.batch_size * sampler.num_retain() / len(forget_dataset))
+        else:
+            retain_batch_size = math.ceil(cfg.train.batch_size * (cfg.dataset.classes - cfg.forgetting_set_size) / cfg.forgetting_set_size)
         forget_batch_size = cfg.train.batch_size
-        retain_loader = DataLoader(retain_dataset, batch_size=retain_batch_size, num_workers=8) 
-        forget_loader = DataLoader(forget_dataset, batch_size=forget_batch_size, num_workers=8)
+        retain_loader = get_dataloader(cfg, retain_dataset, batch_size=retain_batch_size, sampler=sampler, distributed=distributed)
+        forget_loader = get_dataloader(cfg, forget_dataset, batch_size=forget_batch_size, distributed=distributed)
     else:
-        retain_loader = DataLoader(retain_dataset, batch_size=cfg.train.batch_size, num_workers=8)
-        forget_loader = DataLoader(forget_dataset, batch_size=cfg.train.batch_size, num_workers=8)
+        retain_loader = get_dataloader(cfg, retain_dataset, distributed=distributed)
+        forget_loader = get_dataloader(cfg, forget_dataset, distributed=distributed)
     return retain_loader, forget_loader
 
 
@@ -231,4 +537,4 @@ if __name__ == "__main__":
         import matplotlib.pyplot as plt
         for i in range(10):
             img, lbl = test.__getitem__(i)
-            print(img.shape, lbl)
\ No newline at end of file
+            print(img.shape, img.dtype, lbl)
\ No newline at end of file
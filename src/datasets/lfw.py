@@ -0,0 +1,91 @@
+import os
+import shutil
+import numpy as np
+from sklearn.datasets import fetch_lfw_people
+
+SPLITS = ('train', 'val', 'test')
+
+
+def split_per_class(labels, seed=42):
+    """
+    Vectorized train/val/test split: in every (shuffled) class the first four images go to train,
+    the fifth to val and the sixth to test, the remaining ones follow a train, train, val, test pattern.
+    Args:
+        labels (np.ndarray): class of each image.
+        seed (int): seed of the per class shuffling.
+    Returns:
+        indices (dict): split name -> sorted indices of the images in the split.
+    """
+    # the pattern does not reproduce the greedy split of the original loader, LFW checkpoints trained on that split
+    # may have seen images of the current test split and have to be retrained, as well as their derived caches
+    rng = np.random.RandomState(seed)
+    # sort by class, randomly inside each class
+    order = np.lexsort((rng.random_sample(len(labels)), labels))
+    sorted_labels = labels[order]
+    class_start = np.searchsorted(sorted_labels, sorted_labels, side='left')
+    rank = np.arange(len(labels)) - class_start
+
+    split = np.select(
+        [rank < 4, rank == 4, rank == 5, (rank - 6) % 4 < 2, (rank - 6) % 4 == 2],
+        [0, 1, 2, 0, 1],
+        default=2,
+    )
+    return {name: np.sort(order[split == i]) for i, name in enumerate(SPLITS)}
+
+
+def _to_uint8(images):
+    # fetch_lfw_people may return values either in [0, 1] or in [0, 255]
+    scale = 255.0 if images.max() <= 1.0 else 1.0
+    return np.clip(np.rint(images * scale), 0, 255).astype(np.uint8)
+
+
+def _materialize(cache_dir, resize, min_faces_per_person, seed):
+    data = fetch_lfw_people(
+        color=True,
+        resize=resize / 256,  # set resolution
+        min_faces_per_person=min_faces_per_person,
+    )
+    labels = data.target.astype(np.int64)
+    indices = split_per_class(labels, seed)
+    order = np.concatenate([indices[name] for name in SPLITS])
+
+    tmp_dir = cache_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    # images are stored split after split, so that every split is a contiguous slice
+    images = np.lib.format.open_memmap(os.path.join(tmp_dir, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(len(order), 3) + data.images.shape[1:3])
+    images[:] = _to_uint8(data.images[order]).transpose(0, 3, 1, 2)
+    images.flush()
+    del images
+    np.save(os.path.join(tmp_dir, 'labels.npy'), labels[order])
+    np.savez(os.path.join(tmp_dir, 'split_indices.npz'), **indices)
+    os.replace(tmp_dir, cache_dir)
+
+
+def load_lfw_splits(data_dir, resize=224, min_faces_per_person=11, seed=42):
+    """
+    Load the LFW splits from a memory-mapped cache, creating it on the first call.
+    Args:
+        data_dir (str): dataset folder.
+        resize (int): resolution requested to fetch_lfw_people (scaled by 1/256).
+        min_faces_per_person (int): classes with less images are discarded.
+        seed (int): seed of the split.
+    Returns:
+        splits (dict): split name -> (uint8 images [N, 3, H, W], labels [N]).
+    """
+    cache_dir = os.path.join(data_dir, 'lfw_cache', f'resize{resize}_minfaces{min_faces_per_person}_seed{seed}')
+    if not os.path.isdir(cache_dir):
+        _materialize(cache_dir, resize, min_faces_per_person, seed)
+
+    images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(cache_dir, 'labels.npy'), mmap_mode='r')
+    indices = np.load(os.path.join(cache_dir, 'split_indices.npz'))
+
+    splits, start = {}, 0
+    for name in SPLITS:
+        end = start + len(indices[name])
+        splits[name] = (images[start:end], labels[start:end])
+        start = end
+    print(f'Number of classes: {len(np.unique(labels))}')
+    return splits
@@ -0,0 +1,103 @@
+import math
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class RetainSubsampleSampler(Sampler):
+    def __init__(self, targets, forget_indices, retain_fraction=1.0, retain_count=None, seed=0):
+        """
+        Sampler returning, every epoch, all the forget samples and a class-stratified random subset of the retain ones.
+        Args:
+            targets (np.ndarray): label of each sample of the dataset.
+            forget_indices (list): indices of the samples to forget, always sampled.
+            retain_fraction (float): fraction of the retain samples drawn every epoch.
+            retain_count (int): number of retain samples drawn every epoch, overrides retain_fraction.
+            seed (int): base seed, combined with the epoch.
+        """
+        targets = np.asarray(targets, dtype=np.int64)
+        self.forget_indices = np.asarray(forget_indices, dtype=np.int64)
+        forget_mask = np.zeros(len(targets), dtype=bool)
+        forget_mask[self.forget_indices] = True
+        self.retain_indices = np.flatnonzero(~forget_mask)
+        self.retain_targets = targets[self.retain_indices]
+        if retain_count is not None:
+            retain_fraction = min(1.0, retain_count / max(len(self.retain_indices), 1))
+        self.retain_fraction = retain_fraction
+
+        # number of samples drawn from every class, at least one for non empty classes
+        counts = np.bincount(self.retain_targets, minlength=int(targets.max()) + 1 if len(targets) else 0)
+        self.class_counts = np.where(counts > 0, np.maximum(np.round(counts * retain_fraction), 1), 0).astype(np.int64)
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def num_retain(self):
+        return int(self.class_counts.sum())
+
+    def __len__(self):
+        return len(self.forget_indices) + self.num_retain()
+
+    def sample_retain(self, rng):
+        # random order inside every class, then keep the first class_counts[c] samples of class c
+        order = np.lexsort((rng.random_sample(len(self.retain_targets)), self.retain_targets))
+        sorted_targets = self.retain_targets[order]
+        rank = np.arange(len(order)) - np.searchsorted(sorted_targets, sorted_targets, side='left')
+        return self.retain_indices[order[rank < self.class_counts[sorted_targets]]]
+
+    def __iter__(self):
+        rng = np.random.RandomState((self.seed + self.epoch) % 2**32)
+        self.epoch += 1
+        indices = np.concatenate([self.forget_indices, self.sample_retain(rng)])
+        rng.shuffle(indices)
+        return iter(indices.tolist())
+
+
+class RankPartitionSampler(Sampler):
+    def __init__(self, sampler, num_replicas, rank):
+        """
+        Equally long, disjoint share of the indices of a sampler for every rank, padded by repeating the first indices.
+        The wrapped sampler must yield the same indices on every rank, i.e. be seeded identically.
+        Args:
+            sampler (Sampler): sampler of the whole dataset.
+            num_replicas (int): number of ranks.
+            rank (int): rank of the process.
+        """
+        self.sampler = sampler
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return math.ceil(len(self.sampler) / self.num_replicas)
+
+    def __iter__(self):
+        indices = list(self.sampler)
+        indices += indices[:len(self) * self.num_replicas - len(indices)]
+        return iter(indices[self.rank::self.num_replicas])
+
+
+class ShardSampler(Sampler):
+    def __init__(self, length, num_replicas, rank):
+        """Disjoint, unpadded share of a dataset for every rank, for evaluations reduced over the ranks."""
+        self.length = length
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __len__(self):
+        return len(range(self.rank, self.length, self.num_replicas))
+
+    def __iter__(self):
+        return iter(range(self.rank, self.length, self.num_replicas))
+
+
+def get_retain_sampler(cfg, targets, forget_indices):
+    """RetainSubsampleSampler configured by cfg.unlearn, None when the whole retain set is used."""
+    if cfg.unlearn.retain_count is None and cfg.unlearn.retain_fraction >= 1.0:
+        return None
+    seed = cfg.seed if cfg.seed >= 0 else 0
+    return RetainSubsampleSampler(targets, forget_indices, cfg.unlearn.retain_fraction, cfg.unlearn.retain_count, seed)
@@ -0,0 +1,174 @@
+import io
+import os
+import json
+import copy
+import random
+import multiprocessing
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+def encode_image(image, quality=90):
+    """Encoded bytes of an image: files and bytes are kept as they are, PIL images are encoded as JPEG."""
+    if isinstance(image, bytes):
+        return image
+    if isinstance(image, str):
+        with open(image, 'rb') as f:
+            return f.read()
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def decode_image(data, resize):
+    """Decode an encoded image into a uint8 tensor [3, resize, resize]."""
+    img = Image.open(io.BytesIO(data))
+    # let the JPEG decoder downscale by a power of two while decoding
+    img.draft('RGB', (resize, resize))
+    img = img.convert("RGB").resize((resize, resize), Image.BILINEAR)
+    return torch.from_numpy(np.asarray(img).copy()).permute(2, 0, 1)
+
+
+def write_shards(samples, out_dir, shard_size=1000, quality=90):
+    """
+    Pack (image, label) records into fixed-size shards.
+    Every shard is a binary file with the concatenated encoded images and an index [N, 3] with
+    offset, length and label of each record. index.json lists the shards.
+    Args:
+        samples (iterable): (image, label) pairs, images can be file paths, encoded bytes or PIL images.
+        out_dir (str): output folder.
+        shard_size (int): number of records per shard.
+        quality (int): JPEG quality used for images that need to be encoded.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    shards, records, data_file, offset = [], [], None, 0
+
+    def close_shard():
+        data_file.close()
+        name = f"shard_{len(shards):05d}"
+        np.save(os.path.join(out_dir, name + ".idx.npy"), np.asarray(records, dtype=np.int64))
+        shards.append({"data": name + ".bin", "index": name + ".idx.npy", "num_samples": len(records)})
+
+    for image, label in samples:
+        if data_file is None:
+            data_file = open(os.path.join(out_dir, f"shard_{len(shards):05d}.bin"), 'wb')
+            records, offset = [], 0
+        data = encode_image(image, quality)
+        data_file.write(data)
+        records.append((offset, len(data), int(label)))
+        offset += len(data)
+        if len(records) == shard_size:
+            close_shard()
+            data_file = None
+    if data_file is not None:
+        close_shard()
+
+    with open(os.path.join(out_dir, "index.json"), 'w') as f:
+        json.dump({"shards": shards, "num_samples": sum(s["num_samples"] for s in shards)}, f, indent=2)
+    print(f"Written {len(shards)} shards in {out_dir}")
+
+
+class ShardedDataset(IterableDataset):
+    def __init__(self, root, resize=224, shuffle=False, buffer_size=1000, seed=42, keep_classes=None, drop_classes=None):
+        """
+        ShardedDataset class, streams the records written by write_shards.
+        Shards are partitioned among distributed processes and DataLoader workers.
+        Args:
+            root (str): folder with index.json and the shards.
+            resize (int): side of the returned uint8 images.
+            shuffle (bool): shuffle the shards order and the records through a buffer.
+            buffer_size (int): size of the shuffle buffer.
+            seed (int): base seed of the shuffling, combined with the epoch.
+            keep_classes (list): if set, only records of these classes are returned.
+            drop_classes (list): records of these classes are skipped.
+        """
+        self.root = root
+        self.resize = resize
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        # shared with the DataLoader workers, persistent workers keep their copy of the dataset between epochs
+        self._epoch = multiprocessing.Value('l', 0, lock=False)
+        with open(os.path.join(root, "index.json"), 'r') as f:
+            self.shards = json.load(f)["shards"]
+        self.index = [np.load(os.path.join(root, s["index"])) for s in self.shards]
+        self._labels = np.concatenate([idx[:, 2] for idx in self.index]) if self.index else np.zeros(0, dtype=np.int64)
+        self._set_classes(keep_classes, drop_classes)
+
+    def _set_classes(self, keep_classes, drop_classes):
+        self.keep_classes = keep_classes
+        self.drop_classes = drop_classes
+        mask = np.ones(int(self._labels.max()) + 1 if len(self._labels) else 0, dtype=bool)
+        if self.keep_classes is not None:
+            mask[:] = False
+            mask[[c for c in self.keep_classes if c < len(mask)]] = True
+        if self.drop_classes is not None:
+            mask[[c for c in self.drop_classes if c < len(mask)]] = False
+        self._class_mask = mask
+        # labels of the returned records, in shard order
+        self.targets = self._labels[mask[self._labels]]
+
+    def select(self, keep_classes=None, drop_classes=None):
+        """New view of the dataset restricted to some classes, no data is read."""
+        selected = copy.copy(self)
+        selected._set_classes(keep_classes, drop_classes)
+        return selected
+
+    @property
+    def epoch(self):
+        return self._epoch.value
+
+    def set_epoch(self, epoch):
+        self._epoch.value = epoch
+
+    def __len__(self):
+        return len(self.targets)
+
+    def _partition(self):
+        # position of this reader among all the processes and DataLoader workers
+        rank, world_size = 0, 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def _assigned_shards(self, reader, num_readers):
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            # same permutation in every process, so that the partition is disjoint
+            random.Random(self.seed + self.epoch).shuffle(order)
+        return order[reader::num_readers]
+
+    def _records(self, shard_ids):
+        for shard_id in shard_ids:
+            index = self.index[shard_id]
+            with open(os.path.join(self.root, self.shards[shard_id]["data"]), 'rb') as f:
+                data = f.read()
+            for offset, length, label in index:
+                if not self._class_mask[label]:
+                    continue
+                yield data[offset:offset + length], int(label)
+
+    def __iter__(self):
+        reader, num_readers = self._partition()
+        rng = random.Random((self.seed + self.epoch) * num_readers + reader)
+        records = self._records(self._assigned_shards(reader, num_readers))
+        if not self.shuffle:
+            for data, label in records:
+                yield decode_image(data, self.resize), label
+            return
+        buffer = []
+        for record in records:
+            if len(buffer) < self.buffer_size:
+                buffer.append(record)
+                continue
+            i = rng.randrange(len(buffer))
+            data, label = buffer[i]
+            buffer[i] = record
+            yield decode_image(data, self.resize), label
+        rng.shuffle(buffer)
+        for data, label in buffer:
+            yield decode_image(data, self.resize), label
@@ -0,0 +1,66 @@
+import os
+import fcntl
+import shutil
+import tempfile
+import numpy as np
+
+# POSIX shared memory is exposed as a tmpfs on Linux, files there live in RAM
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+PREFIX = 'icus_'
+
+
+def shared_key(dataset, resize, seed):
+    return f'{PREFIX}{dataset}_resize{resize}_seed{seed}'
+
+
+def _publish(path, splits):
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, (images, labels) in splits.items():
+        shared_images = np.lib.format.open_memmap(os.path.join(tmp_path, f'{name}_images.npy'), mode='w+',
+                                                  dtype=np.uint8, shape=images.shape)
+        shared_images[:] = images
+        shared_images.flush()
+        del shared_images
+        np.save(os.path.join(tmp_path, f'{name}_labels.npy'), np.asarray(labels, dtype=np.int64))
+    os.replace(tmp_path, path)
+
+
+def _attach(path, names):
+    return {name: (np.load(os.path.join(path, f'{name}_images.npy'), mmap_mode='r'),
+                   np.load(os.path.join(path, f'{name}_labels.npy'), mmap_mode='r')) for name in names}
+
+
+def attach_or_publish(key, build, names=('train', 'val', 'test')):
+    """
+    Attach zero-copy to the splits published under key, the first process builds and publishes them.
+    Args:
+        key (str): name of the shared splits, see shared_key.
+        build (callable): returns a dict split name -> (uint8 images [N, C, H, W], labels [N]).
+        names (tuple): split names.
+    Returns:
+        splits (dict): split name -> (read-only memory-mapped images, labels).
+    """
+    path = os.path.join(SHARED_DIR, key)
+    # the lock serializes concurrent processes, only the first one builds the splits
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.isdir(path):
+                print(f'Publishing {key} in {SHARED_DIR}')
+                _publish(path, build())
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return _attach(path, names)
+
+
+def remove_shared(key=None):
+    """Remove the published splits with the given key, or all of them if key is None."""
+    for name in os.listdir(SHARED_DIR):
+        if name.startswith(PREFIX) and (key is None or name.startswith(key)):
+            target = os.path.join(SHARED_DIR, name)
+            if os.path.isdir(target):
+                shutil.rmtree(target, ignore_errors=True)
+            else:
+                os.remove(target)
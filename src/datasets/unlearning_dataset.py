@@ -1,12 +1,16 @@
 import torch
 from torch.utils.data import Dataset
 import random
+import numpy as np
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
 from scripts.descr_and_similarity import calculate_embeddings
 import requests
 from transformers import BertModel, BertTokenizer
+from src.datasets.dataset import get_dataloader, get_targets, require_map_style
+from src.datasets.sampler import get_retain_sampler
+from src.models.partial import get_activation_dataset
 
 class UnlearningDataset(Dataset):
     def __init__(self, dataset, forget_indices):
@@ -17,17 +21,36 @@ class UnlearningDataset(Dataset):
             forget_indices (list): index of the samples to forget.
         """
         self.dataset = dataset
-        self.forget_indices = set(forget_indices) 
+        self.targets = get_targets(dataset)
+        self.forget_mask = np.zeros(len(dataset), dtype=bool)
+        self.forget_mask[np.asarray(forget_indices, dtype=np.int64)] = True
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, index):
         input, label = self.dataset[index]
-        infgt = 1 if index in self.forget_indices else 0
+        infgt = int(self.forget_mask[index])
         return input, label, infgt
 
 
+class IndexedDataset(Dataset):
+    def __init__(self, dataset):
+        """
+        IndexedDataset class, appends the sample index to the items of a dataset (used to look up cached outputs).
+        Args:
+            dataset (Dataset): wrapped dataset.
+        """
+        self.dataset = dataset
+        self.targets = get_targets(dataset)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return (*self.dataset[index], index)
+
+
 class IcusUnlearningDataset(Dataset):
     def __init__(self, orig_dataset, nlayers, infgt, model, num_classes, device="cpu"):
         """
@@ -63,10 +86,20 @@ class IcusUnlearningDataset(Dataset):
 def get_unlearning_dataset(cfg, unlearning_method_name, model, train, retain_indices, forget_indices, forgetting_subset): 
     if unlearning_method_name == 'icus' or unlearning_method_name == 'icus_hierarchy':
         num_classes = cfg.dataset.classes
-        infgt = torch.tensor([1 if i in forgetting_subset else 0 for i in range(len(train))])  
+        infgt = torch.zeros(len(train), dtype=torch.long)
+        infgt[list(forgetting_subset)] = 1
         unlearning_train = IcusUnlearningDataset(cfg.dataset.name, cfg.unlearn.nlayers, infgt, model, num_classes, cfg.device)
         unlearning_train = torch.utils.data.DataLoader(unlearning_train, batch_size=cfg.train.batch_size, num_workers=0)
     else:
+        require_map_style(train, 'UnlearningDataset')
         unlearning_train = UnlearningDataset(train, forget_indices)
-        unlearning_train = torch.utils.data.DataLoader(unlearning_train, batch_size=cfg.train.batch_size, num_workers=8)
+        if unlearning_method_name == 'badT' and cfg.unlearn.trainable_blocks is not None:
+            # only the last blocks are trained, over the cached activations of the frozen prefix
+            unlearning_train = get_activation_dataset(cfg, model, unlearning_train, 'badT_train')
+        if unlearning_method_name == 'badT' and (cfg.unlearn.teacher_cache.enabled or cfg.unlearn.trainable_blocks is not None):
+            # samples carry their index, to look up the cached teacher logits
+            unlearning_train = IndexedDataset(unlearning_train)
+        # BadT can iterate all the forget samples and only a subset of the retain ones every epoch
+        sampler = get_retain_sampler(cfg, unlearning_train.targets, forget_indices) if unlearning_method_name == 'badT' else None
+        unlearning_train = get_dataloader(cfg, unlearning_train, sampler=sampler, distributed='train')
     return unlearning_train
@@ -0,0 +1,96 @@
+import contextlib
+import warnings
+import torch
+
+
+def resolve_device(device):
+    """Configured device, falling back to cpu when cuda is requested but not available."""
+    device = torch.device(device)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        print("CUDA is not available, running on cpu")
+        return torch.device('cpu')
+    return device
+
+
+def autocast(device, enabled=True):
+    """Mixed precision context of the device: float16 on cuda, bfloat16 on cpu."""
+    device = torch.device(device)
+    dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=enabled)
+
+
+class NoOpScaler:
+    """GradScaler interface without loss scaling, bfloat16 has the float32 range and does not need it."""
+    def scale(self, loss):
+        return loss
+
+    def unscale_(self, optimizer):
+        pass
+
+    def step(self, optimizer):
+        optimizer.step()
+
+    def update(self):
+        pass
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state):
+        pass
+
+
+def grad_scaler(device):
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.amp.GradScaler()
+    return NoOpScaler()
+
+
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def precision_autocast(device, precision='fp32'):
+    """Autocast context of a precision setting (fp32, bf16 or fp16), fp32 disables autocast."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Precision '{precision}' not recognised, use one of {list(PRECISIONS)}")
+    device = torch.device(device)
+    dtype = PRECISIONS[precision]
+    if dtype == torch.float32:
+        return contextlib.nullcontext()
+    if dtype == torch.float16 and device.type == 'cpu':
+        # cpu autocast is only reliable in bfloat16
+        warnings.warn("fp16 autocast is not supported on cpu, using bf16")
+        dtype = torch.bfloat16
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def precision_scaler(device, precision='fp32'):
+    """Loss scaler of a precision setting, only fp16 on cuda needs scaling."""
+    if precision == 'fp16' and torch.device(device).type == 'cuda':
+        return torch.cuda.amp.GradScaler()
+    return NoOpScaler()
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def setup_device(cfg):
+    """
+    Resolve cfg.device in place and configure the cpu thread pools, called at the start of every entry point.
+    Args:
+        cfg (DictConfig): hydra config, see cfg.device and cfg.cpu.
+    Returns:
+        device (str): resolved device.
+    """
+    cfg.device = str(resolve_device(cfg.device))
+    if cfg.cpu.intra_op_threads is not None:
+        torch.set_num_threads(cfg.cpu.intra_op_threads)
+    if cfg.cpu.inter_op_threads is not None:
+        try:
+            torch.set_num_interop_threads(cfg.cpu.inter_op_threads)
+        except RuntimeError:
+            # can only be set once, before any inter-op parallel work
+            print("Inter-op threads already initialized, cpu.inter_op_threads ignored")
+    return cfg.device
@@ -0,0 +1,128 @@
+import os
+import contextlib
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from omegaconf import OmegaConf
+from src.device import resolve_device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextlib.contextmanager
+def main_process_first():
+    """Run the block on rank 0 first and then on the other ranks, e.g. to build a cache once and load it everywhere."""
+    if is_distributed() and not is_main_process():
+        dist.barrier()
+    yield
+    if is_distributed() and is_main_process():
+        dist.barrier()
+
+
+def all_reduce_sum(tensor):
+    """Sum a tensor over all the ranks in place, no-op in a single process."""
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def average_gradients(parameters):
+    """
+    Average the gradients of the parameters over all the ranks with a single all-reduce, for training loops that are
+    not wrapped by DistributedDataParallel. Missing gradients count as zeros.
+    """
+    if not is_distributed():
+        return
+    parameters = [param for param in parameters if param.requires_grad]
+    if not parameters:
+        return
+    flat = torch.cat([(param.grad if param.grad is not None else torch.zeros_like(param)).reshape(-1) for param in parameters])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= get_world_size()
+    offset = 0
+    for param in parameters:
+        grad = flat[offset:offset + param.numel()].view_as(param)
+        if param.grad is None:
+            param.grad = grad.clone()
+        else:
+            param.grad.copy_(grad)
+        offset += param.numel()
+
+
+def distribute(model):
+    """Wrap a model in DistributedDataParallel when running in several processes, the modules are shared."""
+    if not is_distributed():
+        return model
+    device = next(model.parameters()).device
+    device_ids = [device.index] if device.type == 'cuda' else None
+    return torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
+
+
+def _run(fn, cfg):
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1:
+        dist.init_process_group(backend=cfg.distributed.backend)
+        local_rank = int(os.environ.get('LOCAL_RANK', get_rank()))
+        # cuda falls back to cpu when not available, only an actual cuda device is pinned to the local rank
+        device = resolve_device(cfg.device)
+        cfg.device = str(device)
+        if device.type == 'cuda':
+            cfg.device = f'cuda:{local_rank}'
+            torch.cuda.set_device(local_rank)
+        if cfg.cpu.intra_op_threads is None:
+            # the cores of the node are split between the processes
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+        if cfg.seed == -1:
+            # every rank starts from the seed of rank 0
+            seed = torch.tensor([int.from_bytes(os.urandom(4), byteorder='big') if is_main_process() else 0], dtype=torch.long)
+            dist.broadcast(seed, src=0)
+            cfg.seed = int(seed.item())
+    try:
+        return fn(cfg)
+    finally:
+        if is_distributed():
+            dist.destroy_process_group()
+
+
+def _spawned(rank, fn, cfg, world_size):
+    os.environ['RANK'] = os.environ['LOCAL_RANK'] = str(rank)
+    os.environ['WORLD_SIZE'] = str(world_size)
+    _run(fn, cfg)
+
+
+def launch(fn, cfg):
+    """
+    Run fn(cfg) in cfg.distributed.world_size local processes, see cfg.distributed.
+    Processes started by torchrun (RANK set in the environment) run fn directly and join the process group, a
+    world_size of 1 runs fn in the current process.
+    Args:
+        fn (callable): entry point, a module-level function of the config.
+        cfg (DictConfig): hydra config.
+    """
+    world_size = cfg.distributed.world_size
+    if 'RANK' in os.environ or world_size <= 1:
+        return _run(fn, cfg)
+    # the spawned processes have no hydra context, interpolations such as ${hydra:runtime.cwd} are resolved here
+    OmegaConf.resolve(cfg)
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(cfg.distributed.port))
+    mp.spawn(_spawned, args=(fn, cfg, world_size), nprocs=world_size, join=True)
@@ -1,15 +1,24 @@
 import flatdict
 from omegaconf import DictConfig, OmegaConf
+from src.distributed import is_main_process
 
 def hp_from_cfg(cfg):
     cfg = OmegaConf.to_container(cfg, resolve=True)
     return dict(flatdict.FlatDict(cfg, delimiter="/"))
 
+class NullLogger:
+    """Logger of the non-zero ranks, only rank 0 logs."""
+    def log_metrics(self, metrics, step=None):
+        pass
+
+
 def get_loggers(cfg):
     """Returns a list of loggers
     cfg: hydra config
     """
-    
+    if not is_main_process():
+        return NullLogger()
+
     from pytorch_lightning.loggers import WandbLogger
     import wandb
     hyperparameters = hp_from_cfg(cfg)
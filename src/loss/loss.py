@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import time
 
 
@@ -18,12 +19,14 @@ class NegGradPlusLoss(nn.Module):
     def __init__(self, negative_classes=[]):
         super().__init__()
         self.criterion = nn.CrossEntropyLoss(reduction='none')
-        self.negative_classes = negative_classes
+        # forget classes as a device tensor, looked up with isin instead of a python loop over the targets
+        self.register_buffer('negative_classes', torch.as_tensor(list(negative_classes), dtype=torch.long), persistent=False)
 
     def forward(self, logits, targets):
+        if self.negative_classes.device != targets.device:
+            self.negative_classes = self.negative_classes.to(targets.device)
         loss = self.criterion(logits, targets)
-        negative_mask = torch.tensor([1.0 if t not in self.negative_classes else -1.0 for t in targets], device=logits.device)
-        loss = loss * negative_mask
+        loss = torch.where(torch.isin(targets, self.negative_classes), -loss, loss)
         return loss.mean()
 
 class RandRelabelingLoss(nn.Module):
@@ -31,14 +34,40 @@ class RandRelabelingLoss(nn.Module):
     def __init__(self, num_classes, negative_classes=[]):
         super(RandRelabelingLoss, self).__init__()
         self.num_classes = num_classes
-        self.positive_classes = list(set(range(num_classes)) - set(negative_classes))
+        # lookup table of the retain classes, random labels are gathered from it
+        positive_classes = sorted(set(range(num_classes)) - set(negative_classes))
+        self.register_buffer('positive_classes', torch.as_tensor(positive_classes, dtype=torch.long), persistent=False)
         self.criterion = nn.CrossEntropyLoss(reduction='none')
 
     def forward(self, logits, targets):
+        if self.positive_classes.device != targets.device:
+            self.positive_classes = self.positive_classes.to(targets.device)
         batch_size = targets.size(0)
-        new_targets = torch.randint(0, len(self.positive_classes), (batch_size,), device=targets.device)
-        new_targets = torch.tensor([self.positive_classes[t] for t in new_targets], device=targets.device)
+        new_targets = self.positive_classes[torch.randint(0, len(self.positive_classes), (batch_size,), device=targets.device)]
         loss = self.criterion(logits, new_targets)
         return loss.mean()
 
 
+def distill_kl_loss(student_logits, teacher_logits, temperature):
+    """KL-divergence loss for knowledge distillation, summed over the classes and averaged over the batch (Scrub)."""
+    student_out = F.log_softmax(student_logits / temperature, dim=1)
+    teacher_out = F.softmax(teacher_logits / temperature, dim=1)
+    return F.kl_div(student_out, teacher_out, reduction='sum') * (temperature ** 2) / student_logits.shape[0]
+
+
+def teacher_mix_kl_loss(student_logits, full_teacher_logits, unlearn_teacher_logits, infgt, temperature):
+    """
+    KL-divergence loss towards the unlearning teacher on the forget samples and the full teacher on the others (BadT).
+    Args:
+        student_logits (torch.Tensor): [B, C] logits of the student.
+        full_teacher_logits (torch.Tensor): [B, C] logits of the original model.
+        unlearn_teacher_logits (torch.Tensor): [B, C] logits of the random model.
+        infgt (torch.Tensor): [B] 1 for the forget samples, 0 for the retain ones.
+        temperature (float): softmax temperature.
+    """
+    # one select instead of the weighted sum of the two teacher distributions
+    forget = infgt.bool().unsqueeze(1)
+    teacher_logits = torch.where(forget, unlearn_teacher_logits, full_teacher_logits)
+    teacher_out = F.softmax(teacher_logits / temperature, dim=1)
+    student_out = F.log_softmax(student_logits / temperature, dim=1)
+    return F.kl_div(student_out, teacher_out)
@@ -7,15 +7,16 @@ import hydra
 from sklearn.svm import SVC
 from torch.utils.data.sampler import SubsetRandomSampler
 from torch.utils.data import DataLoader
-from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
+from sklearn.metrics import f1_score, precision_score, recall_score
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from src.distributed import all_reduce_sum
 
 
 def compute_predictions(model, loader):
     model.eval()
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = next(model.parameters()).device
     y_true = list()
     y_pred = list()
     with torch.no_grad():
@@ -29,23 +30,60 @@ def compute_predictions(model, loader):
     return y_true, y_pred
 
 
+class RetainForgetAccuracy:
+    def __init__(self, num_classes, forgetting_subset=(), device='cpu'):
+        """
+        Accumulates a [C, C] confusion matrix (rows: true class, columns: predicted class) on the device.
+        Args:
+            num_classes (int): number of classes.
+            forgetting_subset (list): classes to forget.
+            device (str): device of the predictions.
+        """
+        self.num_classes = num_classes
+        self.matrix = torch.zeros(num_classes, num_classes, dtype=torch.long, device=device)
+        self.forget_mask = torch.zeros(num_classes, dtype=torch.bool, device=device)
+        forgetting_subset = [int(c) for c in forgetting_subset if int(c) < num_classes]
+        self.forget_mask[forgetting_subset] = True
+
+    def reset(self):
+        self.matrix.zero_()
+
+    def update(self, outputs, targets):
+        """Add a batch, outputs are either logits [B, C] or predicted classes [B]."""
+        preds = outputs.argmax(dim=1) if outputs.dim() > 1 else outputs
+        idx = targets.to(self.matrix.device, torch.long) * self.num_classes + preds.to(self.matrix.device, torch.long)
+        self.matrix += torch.bincount(idx, minlength=self.num_classes ** 2).view(self.num_classes, self.num_classes)
+
+    def sync(self):
+        """Sum the confusion matrices accumulated by all the ranks over their shares of the samples."""
+        all_reduce_sum(self.matrix)
+
+    def compute(self):
+        """Overall, retain, forget and per-class accuracy as fractions, 0 for empty subsets."""
+        correct = self.matrix.diagonal().double()
+        total = self.matrix.sum(dim=1).double()
+        ratio = lambda c, t: (c / t).item() if t > 0 else 0.0
+        return {
+            'accuracy': ratio(correct.sum(), total.sum()),
+            'accuracy_retaining': ratio(correct[~self.forget_mask].sum(), total[~self.forget_mask].sum()),
+            'accuracy_forgetting': ratio(correct[self.forget_mask].sum(), total[self.forget_mask].sum()),
+            'accuracy_per_class': torch.where(total > 0, correct / total.clamp(min=1), torch.zeros_like(total)).tolist(),
+            'total_retaining': int(total[~self.forget_mask].sum().item()),
+            'total_forgetting': int(total[self.forget_mask].sum().item()),
+        }
+
+
 def compute_classification_metrics(model, test_loader, num_classes, forgetting_subset):
-    
-    y_true, y_pred = compute_predictions(model, test_loader)
-
-    # compute metrics three times (on whole dataset, on the forgetting subset, on the retaining subset)
-    metrics = dict()
-    # whole dataset
-    metrics['accuracy'] = accuracy_score(y_true, y_pred)
-    # forgetting subset
-    y_true_forgetting = [y_true[i] for i in range(len(y_true)) if y_true[i] in forgetting_subset]
-    y_pred_forgetting = [y_pred[i] for i in range(len(y_pred)) if y_true[i] in forgetting_subset]
-    metrics['accuracy_forgetting'] = accuracy_score(y_true_forgetting, y_pred_forgetting)
-    # retaining subset
-    y_true_retaining = [y_true[i] for i in range(len(y_true)) if y_true[i] not in forgetting_subset]
-    y_pred_retaining = [y_pred[i] for i in range(len(y_pred)) if y_true[i] not in forgetting_subset]
-    metrics['accuracy_retaining'] = accuracy_score(y_true_retaining, y_pred_retaining)
-    return metrics
+    model.eval()
+    device = next(model.parameters()).device
+    accuracy = RetainForgetAccuracy(num_classes, forgetting_subset, device)
+    with torch.no_grad():
+        for x, y in test_loader:
+            accuracy.update(model(x.to(device)), y.to(device))
+
+    # metrics on the whole dataset, on the forgetting subset and on the retaining subset
+    metrics = accuracy.compute()
+    return {k: metrics[k] for k in ['accuracy', 'accuracy_forgetting', 'accuracy_retaining']}
 
 def compute_metrics(model, test_loader, num_classes, forgetting_subset):
     classification_metrics = compute_classification_metrics(model, test_loader, num_classes, forgetting_subset)
@@ -74,12 +74,24 @@ class Classifier(torch.nn.Module):
                 torch.nn.AvgPool2d(kernel_size=13, stride=1, padding=0)
             )
 
+    def get_head(self):
+        # classifier head set by _set_model_classifier
+        for name in ['fc', 'head', 'heads', 'classifier']:
+            if hasattr(self.model, name):
+                return getattr(self.model, name)
+        raise ValueError("Unsupported model type")
+
+    def backbone_frozen(self):
+        """True if only the parameters of the head are trainable, i.e. the model was built with finetune=False."""
+        head = {id(param) for param in self.get_head().parameters()}
+        return not any(param.requires_grad for param in self.model.parameters() if id(param) not in head)
+
     def extract_features(self, x):
         if "DenseNet" in self.weights_cls:
             features = self.model.features(x)
-            out = nn.ReLU(inplace=True)(features)
-            out = nn.AdaptiveAvgPool2d((1, 1))(out)
-            out = torch.flatten(out, 1)
+            out = torch.nn.ReLU(inplace=True)(features)
+            out = torch.nn.AdaptiveAvgPool2d((1, 1))(out)
+            features = torch.flatten(out, 1)
         elif "MaxVit" in self.weights_cls:
             features = self.model.forward_features(x)
         elif "ResNet" in self.weights_cls or "RegNet" in self.weights_cls or "GoogLeNet" in self.weights_cls:
@@ -96,11 +108,9 @@ class Classifier(torch.nn.Module):
         return features
 
     def get_weights(self, nclasses, nlayers):
-        shared = torch.empty(0)
-        distinct = torch.empty(0)
-        if torch.cuda.is_available():
-            shared = shared.to('cuda')
-            distinct = distinct.to('cuda')
+        device = next(self.parameters()).device
+        shared = torch.empty(0, device=device)
+        distinct = torch.empty(0, device=device)
 
         if self.model_name == 'resnet18':
             for l in nlayers:
@@ -138,9 +148,9 @@ class Classifier(torch.nn.Module):
         idx_distinct = 0
         idx_shared = 0
 
-        if torch.cuda.is_available():
-            distinct = distinct.to('cuda')
-            shared = shared.to('cuda')
+        device = next(self.parameters()).device
+        distinct = distinct.to(device)
+        shared = shared.to(device)
 
         if self.model_name == 'resnet18':
             for l in nlayers:
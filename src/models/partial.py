@@ -0,0 +1,160 @@
+import os
+import hashlib
+import numpy as np
+import torch
+import torch.nn as nn
+import tqdm
+from torch.utils.data import Dataset, IterableDataset
+from src.utils import state_dict_hash
+from src.datasets.dataset import get_dataloader, dataset_fingerprint
+from src.distributed import main_process_first
+
+
+def _resnet_stages(model):
+    # unwrap Classifier / ReferenceModel down to the ResNet
+    while not hasattr(model, 'layer1') and hasattr(model, 'model'):
+        model = model.model
+    if not hasattr(model, 'layer1'):
+        raise ValueError(f"Partial fine-tuning is not supported for {type(model).__name__}, only ResNet models are")
+    stem = [model.conv1, model.bn1, model.relu] + ([model.maxpool] if hasattr(model, 'maxpool') else [])
+    layers = [getattr(model, f'layer{i}') for i in range(1, 5) if hasattr(model, f'layer{i}')]
+    pool = model.avgpool if hasattr(model, 'avgpool') else model.avg_pool
+    return [nn.Sequential(*stem)] + layers + [nn.Sequential(pool, nn.Flatten(1), model.fc)]
+
+
+def split_model(model, trainable_blocks):
+    """
+    Split a ResNet into a frozen prefix and a trainable suffix, sharing the modules of the model.
+    Args:
+        model (nn.Module): Classifier or ResNet model.
+        trainable_blocks (int): number of trailing blocks in the suffix, the head counts as one (2 = layer4 + fc).
+    Returns:
+        prefix (nn.Sequential), suffix (nn.Sequential)
+    """
+    stages = _resnet_stages(model)
+    if not 0 < trainable_blocks < len(stages):
+        raise ValueError(f"trainable_blocks must be between 1 and {len(stages) - 1}, got {trainable_blocks}")
+    return nn.Sequential(*stages[:-trainable_blocks]), nn.Sequential(*stages[-trainable_blocks:])
+
+
+class SuffixModel(nn.Module):
+    def __init__(self, model, trainable_blocks):
+        """
+        Last trainable_blocks blocks of a model, run over the cached activations of the prefix.
+        The modules are shared with model and the parameters of the prefix are frozen.
+        Args:
+            model (nn.Module): Classifier, ResNet or ReferenceModel.
+            trainable_blocks (int): see split_model.
+        """
+        super().__init__()
+        prefix, self.suffix = split_model(model, trainable_blocks)
+        for param in prefix.parameters():
+            param.requires_grad = False
+
+    def forward(self, x):
+        # activations may be stored with a different precision than the weights
+        return self.suffix(x.to(next(self.suffix.parameters()).dtype)).float()
+
+
+class ActivationDataset(Dataset):
+    def __init__(self, dataset, path):
+        """
+        ActivationDataset class, memory-mapped prefix activations (or features) of a dataset followed by the other fields of its items.
+        Args:
+            dataset (Dataset): dataset the activations were computed on.
+            path (str): cache file prefix, see get_activation_dataset.
+        """
+        self.dataset = dataset
+        self.activations = np.load(path + '_activations.npy', mmap_mode='r')
+        self.fields = np.load(path + '_fields.npy')
+        self.targets = self.fields[:, 0]
+        self.precomputed = True  # get_dataloader does not apply the batch transform
+
+    def __len__(self):
+        return len(self.activations)
+
+    def __getitem__(self, index):
+        return (torch.from_numpy(np.array(self.activations[index])), *(int(v) for v in self.fields[index]))
+
+
+def _cache_outputs(cfg, model, encoder, dataset, path, dtype, desc):
+    # run the frozen encoder, a wrapper of model's modules, over a dataset once, storing its outputs and the other
+    # fields of the items; the train/eval mode of model is restored afterwards
+    training = model.training
+    model.eval()
+    activations, fields, start = None, [], 0
+    with torch.no_grad():
+        for batch in tqdm.tqdm(get_dataloader(cfg, dataset), desc=desc):
+            out = encoder(batch[0].to(cfg.device)).float().cpu().numpy()
+            if activations is None:
+                activations = np.lib.format.open_memmap(path + '_activations.npy', mode='w+', dtype=dtype,
+                                                        shape=(len(dataset), *out.shape[1:]))
+            activations[start:start + len(out)] = out.astype(dtype)
+            fields.append(np.stack([np.asarray(field) for field in batch[1:]], axis=1))
+            start += len(out)
+    activations.flush()
+    del activations
+    model.train(training)
+    # the fields file is written last, it marks the cache as complete
+    np.save(path + '_fields.npy', np.concatenate(fields).astype(np.int64))
+
+
+def get_activation_dataset(cfg, model, dataset, name):
+    """
+    Compute the activations of the frozen prefix over a dataset in one pass, or reuse them if already cached.
+    Args:
+        cfg (DictConfig): hydra config, see cfg.unlearn.trainable_blocks and cfg.unlearn.activation_dtype.
+        model (nn.Module): model whose prefix is run.
+        dataset (Dataset): map-style dataset of (image, int, ...) items.
+        name (str): name of the cache, e.g. the split.
+    Returns:
+        ActivationDataset
+    """
+    if isinstance(dataset, IterableDataset):
+        raise ValueError("Prefix activations can only be cached for map-style datasets")
+    trainable_blocks = cfg.unlearn.trainable_blocks
+    prefix = split_model(model, trainable_blocks)[0]
+    dtype = np.dtype(cfg.unlearn.activation_dtype)
+    key = hashlib.sha1(f'{state_dict_hash(prefix)}_{dataset_fingerprint(dataset)}_{cfg.dataset.resize}_{dtype}_{trainable_blocks}'.encode()).hexdigest()[:16]
+    cache_dir = os.path.join(cfg.currentDir, cfg.cache.path, 'activations')
+    path = os.path.join(cache_dir, f'{cfg.dataset.name}_{name}_{key}')
+    with main_process_first():
+        if not os.path.exists(path + '_fields.npy'):
+            os.makedirs(cache_dir, exist_ok=True)
+            _cache_outputs(cfg, model, prefix, dataset, path, dtype, f'Caching {name} activations')
+    return ActivationDataset(dataset, path)
+
+
+class FeatureExtractor(nn.Module):
+    def __init__(self, model):
+        """Penultimate features of a Classifier, see Classifier.extract_features."""
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.extract_features(x)
+
+
+def get_feature_dataset(cfg, model, dataset, name):
+    """
+    Extract the penultimate features of a frozen-backbone Classifier over a dataset in one pass, or reuse them if
+    already cached. The features are stored in float32 and do not depend on the head, so the cache is shared by
+    every head trained on top of the same backbone.
+    Args:
+        cfg (DictConfig): hydra config.
+        model (Classifier): model with a frozen backbone.
+        dataset (Dataset): map-style dataset of (image, int, ...) items.
+        name (str): name of the cache, e.g. the split.
+    Returns:
+        ActivationDataset
+    """
+    if isinstance(dataset, IterableDataset):
+        raise ValueError("Features can only be cached for map-style datasets")
+    key = hashlib.sha1(f'{state_dict_hash(model, exclude=model.get_head())}_{dataset_fingerprint(dataset)}_{cfg.dataset.resize}'.encode()).hexdigest()[:16]
+    cache_dir = os.path.join(cfg.currentDir, cfg.cache.path, 'features')
+    path = os.path.join(cache_dir, f'{cfg.dataset.name}_{name}_{key}')
+    with main_process_first():
+        if not os.path.exists(path + '_fields.npy'):
+            os.makedirs(cache_dir, exist_ok=True)
+            _cache_outputs(cfg, model, FeatureExtractor(model), dataset, path, np.float32, f'Extracting {name} features')
+    return ActivationDataset(dataset, path)
@@ -147,7 +147,7 @@ class ResNet18(nn.Module):
 
     def get_weights(self, nclasses, nlayers):
         # Initialize `shared` tensor on the same device as the model.
-        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        device = next(self.parameters()).device
         shared = torch.empty(0, device=device)
         
         distinct = []
@@ -251,7 +251,7 @@ class ResNetCustom(nn.Module):
 
     def get_weights(self, nclasses, nlayers):
         # Initialize `shared` tensor on the same device as the model.
-        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        device = next(self.parameters()).device
         shared = torch.empty(0, device=device)
         
         distinct = []
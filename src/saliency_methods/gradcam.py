@@ -1,11 +1,11 @@
 import hydra
 import matplotlib.pyplot as plt
-import torch.utils.data as data
 from torch import nn
 
 from pytorch_grad_cam import GradCAM
 
 from src.models.classifier import Classifier
+from src.device import setup_device
 from src.utils import *
 
 
@@ -52,7 +52,7 @@ def main(cfg):
         finetune=False)
     weights = os.path.join(cfg.currentDir, cfg.train.save_path, cfg.dataset.name + '_' + cfg.model + '.pth')
     model.load_state_dict(torch.load(weights, map_location=cfg.device))
-    device = torch.device(cfg.device if torch.cuda.is_available() else "cpu")
+    device = setup_device(cfg)
     model = model.to(device).eval()
 
     # Load ICUS UNLEARNED model
@@ -83,12 +83,12 @@ def main(cfg):
     model_unlearned_badt = model_unlearned_badt.to(device).eval()
 
 
-    from src.datasets.dataset import load_dataset
+    from src.datasets.dataset import load_dataset, get_dataloader
 
     # Load test dataset
     data_dir = os.path.join(cfg.currentDir, cfg.dataset.path)
     train, val, test = load_dataset(cfg.dataset.name, data_dir, cfg.dataset.resize)
-    dataloader = data.DataLoader(test, batch_size=cfg.train.batch_size, shuffle=True)
+    dataloader = get_dataloader(cfg, test, shuffle=True)
 
     # Initialize the Saliency method
     target_layers_name = cfg.target_layers[cfg.weights_name.split('_Weights')[0]]
@@ -0,0 +1,187 @@
+import os
+import math
+import contextlib
+import torch
+import torch.nn as nn
+import tqdm
+from torch.utils.checkpoint import checkpoint
+from src.metrics.metrics import RetainForgetAccuracy
+from src.device import precision_autocast
+from src.distributed import all_reduce_sum
+
+
+def accumulate_gradients(forward_loss, batch, microbatch_size=None, scaler=None, no_sync=None):
+    """
+    Backward pass of a logical batch split in microbatches, the gradient of each microbatch is weighted by its size
+    so that the accumulated gradient is the one of the batch-mean loss over the whole logical batch.
+    Batch norm statistics are computed per microbatch.
+    Args:
+        forward_loss (callable): maps the items of a microbatch to (outputs, batch-mean loss).
+        batch (tuple): items of the logical batch, tensors are split along the first dimension.
+        microbatch_size (int): size of the microbatches, None processes the whole batch at once.
+        scaler (GradScaler): mixed precision loss scaler, if any.
+        no_sync (callable): context manager skipping the gradient all-reduce, e.g. DistributedDataParallel.no_sync,
+            used for all the microbatches but the last one.
+    Returns:
+        outputs (torch.Tensor): detached outputs of the logical batch.
+        loss (torch.Tensor): detached loss of the logical batch.
+    """
+    size = len(batch[0])
+    step = microbatch_size if microbatch_size else size
+    outputs, total = [], 0.0
+    for start in range(0, size, step):
+        micro = [item[start:start + step] if torch.is_tensor(item) else item for item in batch]
+        last = start + step >= size
+        with no_sync() if no_sync is not None and not last else contextlib.nullcontext():
+            output, loss = forward_loss(*micro)
+            loss = loss * (len(micro[0]) / size)
+            (scaler.scale(loss) if scaler is not None else loss).backward()
+        outputs.append(output.detach())
+        total += loss.detach()
+    return torch.cat(outputs), total
+
+
+def evaluate(model, loader, criterion, num_classes, forgetting_subset=(), device='cpu', precision='fp32'):
+    """
+    Mean loss and retain/forget accuracies of a model over a loader, with the given precision.
+    With distributed loaders, see get_dataloader, the results are reduced over the ranks.
+    Returns:
+        loss (float), metrics (dict): see RetainForgetAccuracy.compute.
+    """
+    model.eval()
+    accuracy = RetainForgetAccuracy(num_classes, forgetting_subset, device)
+    total_loss, batches = 0.0, 0
+    with torch.no_grad(), precision_autocast(device, precision):
+        for x, y, *_ in tqdm.tqdm(loader):
+            x, y = x.to(device), y.to(device)
+            y_pred = model(x)
+            total_loss += criterion(y_pred.float(), y).item()
+            batches += 1
+            accuracy.update(y_pred, y)
+    accuracy.sync()
+    # the batches actually seen, len(loader) of a streaming dataset is the full length on every rank
+    total = all_reduce_sum(torch.tensor([total_loss, batches], dtype=torch.float64, device=device))
+    return (total[0] / total[1].clamp(min=1)).item(), accuracy.compute()
+
+
+class EarlyStopper:
+    def __init__(self, monitor='val_loss', patience=10, min_delta=0.0, mode=None):
+        """
+        Tracks the best value of a validation metric and stops after patience epochs without improvement.
+        Args:
+            monitor (str): name of the metric, e.g. val_loss or val_acc.
+            patience (int): epochs without improvement before stopping.
+            min_delta (float): minimum change counted as an improvement.
+            mode (str): min or max, by default min for losses and max otherwise.
+        """
+        self.monitor = monitor
+        self.patience = patience
+        self.min_delta = min_delta
+        self.mode = mode if mode is not None else ('min' if 'loss' in monitor else 'max')
+        if self.mode not in ['min', 'max']:
+            raise ValueError(f"Mode '{self.mode}' not recognised, use min or max")
+        self.best = math.inf if self.mode == 'min' else -math.inf
+        self.best_epoch = -1
+        self.bad_epochs = 0
+        self.stopped = False  # set by the training loop when it stops early, saved so that a resumed run exits
+
+    def step(self, metrics, epoch):
+        """Record the metrics of an epoch, returns True if the monitored value improved."""
+        if self.monitor not in metrics:
+            raise ValueError(f"Monitored metric '{self.monitor}' not found, available: {list(metrics)}")
+        value = metrics[self.monitor]
+        improved = value < self.best - self.min_delta if self.mode == 'min' else value > self.best + self.min_delta
+        if improved:
+            self.best, self.best_epoch, self.bad_epochs = value, epoch, 0
+        else:
+            self.bad_epochs += 1
+        return improved
+
+    @property
+    def should_stop(self):
+        return self.bad_epochs >= self.patience
+
+    def state_dict(self):
+        return {'best': self.best, 'best_epoch': self.best_epoch, 'bad_epochs': self.bad_epochs, 'stopped': self.stopped}
+
+    def load_state_dict(self, state):
+        self.best, self.best_epoch, self.bad_epochs = state['best'], state['best_epoch'], state['bad_epochs']
+        self.stopped = state.get('stopped', False)
+
+
+def checkpoint_paths(path):
+    """Best weights and last training state files of a final checkpoint path."""
+    stem = os.path.splitext(path)[0]
+    return stem + '_best.pth', stem + '_last.pth'
+
+
+def save_training_state(path, epoch, model, optimizer, scaler, stopper):
+    """
+    Save the state needed to resume training after epoch, the file is replaced atomically.
+    """
+    state = {
+        'epoch': epoch,
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scaler': scaler.state_dict(),
+        'stopper': stopper.state_dict(),
+        'rng': torch.get_rng_state(),
+    }
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_training_state(path, model, optimizer, scaler, stopper, device='cpu'):
+    """
+    Restore a state saved by save_training_state in place.
+    Returns:
+        epoch (int): first epoch to run.
+    """
+    state = torch.load(path, map_location=device)
+    model.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    scaler.load_state_dict(state['scaler'])
+    stopper.load_state_dict(state['stopper'])
+    torch.set_rng_state(state['rng'].cpu())
+    print(f"Resuming from epoch {state['epoch'] + 1}, {path}")
+    return state['epoch'] + 1
+
+
+_checkpointed_classes = {}
+
+
+def _checkpointed_class(cls):
+    # subclass recomputing the activations of the module in the backward pass, the state dict keys are unchanged
+    if cls not in _checkpointed_classes:
+        def forward(self, *args):
+            if self.training and torch.is_grad_enabled():
+                return checkpoint(super(checkpointed, self).forward, *args, use_reentrant=False)
+            return super(checkpointed, self).forward(*args)
+        checkpointed = type(f'Checkpointed{cls.__name__}', (cls,), {'forward': forward})
+        _checkpointed_classes[cls] = checkpointed
+    return _checkpointed_classes[cls]
+
+
+def _backbone_stages(model):
+    while hasattr(model, 'model') and not hasattr(model, 'layer1'):
+        model = model.model
+    if hasattr(model, 'layer1'):  # ResNet
+        return [getattr(model, f'layer{i}') for i in range(1, 5) if hasattr(model, f'layer{i}')]
+    if hasattr(model, 'encoder') and hasattr(model.encoder, 'layers'):  # ViT
+        return list(model.encoder.layers)
+    if hasattr(model, 'features') and isinstance(model.features, nn.Sequential):  # ConvNeXt, EfficientNet, Swin, ...
+        return list(model.features)
+    raise ValueError(f"Activation checkpointing is not supported for {type(model).__name__}")
+
+
+def enable_activation_checkpointing(model):
+    """
+    Recompute the activations of the backbone stages in the backward pass instead of storing them.
+    Only applies in training mode with gradients enabled, batch norm running statistics are updated twice per step.
+    Args:
+        model (nn.Module): Classifier or ResNet model, modified in place.
+    """
+    for stage in _backbone_stages(model):
+        if type(stage) not in _checkpointed_classes.values():
+            stage.__class__ = _checkpointed_class(type(stage))
+    return model
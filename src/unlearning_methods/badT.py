@@ -1,34 +1,52 @@
-import torch, copy
-import torch.nn.functional as F
+import torch
 import torch.nn as nn
 import tqdm
-from torch.cuda.amp import autocast, GradScaler
 from src.unlearning_methods.base import BaseUnlearningMethod
+from src.unlearning_methods.teacher_cache import TeacherLogitCache
+from src.unlearning_methods.reference import ReferenceModel, RandomReferenceModel, reference_dtype
+from src.models.partial import SuffixModel
+from src.datasets.unlearning_dataset import IndexedDataset
+from src.loss.loss import teacher_mix_kl_loss
+from src.training import accumulate_gradients
+from src.distributed import average_gradients, all_reduce_sum, get_world_size
+from src.device import autocast, grad_scaler
 #STUFF TO BE TESTED
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 
 
+def _image_dataset(dataset):
+    # indexed image dataset the cached prefix activations of a loader were computed from, in the same order
+    while not getattr(dataset, 'precomputed', False):
+        dataset = dataset.dataset
+    return IndexedDataset(dataset.dataset)
+
+
 class BadT(BaseUnlearningMethod):
     def __init__(self, opt, model, forgetting_subset, logger=None):
         super().__init__(opt, model)
         print("BadT initialization")
-        self.og_model = copy.deepcopy(model)  # copy the model
-        self.og_model.to(self.opt.device)
-        self.og_model.eval()  # put the model in evaluation mode
+        # frozen copy of the model, stored in reduced precision
+        self.og_model = ReferenceModel(model, reference_dtype(opt.unlearn.reference_dtype, opt.device), opt.device)
         self.forgetting_subset = forgetting_subset
         self.logger=logger
         
-        # create a random model
-        self.random_model = copy.deepcopy(model)
-        self.random_model.apply(self._random_weights_init)
-        self.random_model.to(self.opt.device)
-        self.random_model.eval() 
+        # random model, generated on first use from a fixed seed (not the run seed, often random), so that the same
+        # teacher and its cached logits are reused across runs
+        self.random_model = RandomReferenceModel(self.og_model, self._random_weights_init, seed=opt.unlearn.random_teacher_seed)
+        self.student, self.full_teacher, self.unlearn_teacher = self.model, self.og_model, self.random_model
+        if opt.unlearn.trainable_blocks is not None:
+            # only the last blocks are trained, the loader yields the cached activations of the frozen prefix
+            self.student = SuffixModel(self.model, opt.unlearn.trainable_blocks)
+            self.full_teacher = SuffixModel(self.og_model, opt.unlearn.trainable_blocks)
+            # the random teacher stays a fully random network: its logits are computed once from the images, since
+            # running its random suffix on the trained prefix activations would change the unlearning signal
         
         # Initialize the optimizer, scheduler and scaler
-        self.optimizer = torch.optim.SGD(self.model.parameters(), lr=self.opt.unlearn.lr, momentum=0.9, weight_decay=0.001)
+        self.optimizer = torch.optim.SGD(self.student.parameters(), lr=self.opt.unlearn.lr, momentum=0.9, weight_decay=0.001)
         self.scheduler = ReduceLROnPlateau(self.optimizer, mode='min', factor=0.5, patience=10, verbose=False)
-        self.scaler = GradScaler()
+        self.scaler = grad_scaler(opt.device)
         self.kltemp = opt.unlearn.temp  # Temperature for KL-divergenza (knowledge distillation)
+        self.caches = {}
 
     def _random_weights_init(self, model):
         if isinstance(model, nn.Conv2d) or isinstance(model, nn.Linear):
@@ -36,24 +54,37 @@ class BadT(BaseUnlearningMethod):
             if model.bias is not None:
                 torch.nn.init.zeros_(model.bias)
 
-    def forward_pass(self, sample, target, infgt):
-        output = self.model(sample)
-        
-        # Calculate logits (original e random)
-        full_teacher_logits = self.og_model(sample)
-        unlearn_teacher_logits = self.random_model(sample)
-        
-        # Apply softmax 
-        f_teacher_out = torch.nn.functional.softmax(full_teacher_logits / self.kltemp, dim=1)
-        u_teacher_out = torch.nn.functional.softmax(unlearn_teacher_logits / self.kltemp, dim=1)
+    def unlearn(self, train_loader, test_loader, val_loader=None):
+        partial = self.opt.unlearn.trainable_blocks is not None
+        if self.opt.unlearn.teacher_cache.enabled:
+            # the full teacher is frozen, its logits are computed once instead of at every step
+            self.caches['full'] = TeacherLogitCache.build(self.opt, self.full_teacher, train_loader.dataset, 'badT_full')
+        if self.opt.unlearn.teacher_cache.enabled or partial:
+            # so is the random teacher, which is always run on the images (the items of the loader are prefix
+            # activations in partial mode)
+            dataset = _image_dataset(train_loader.dataset) if partial else train_loader.dataset
+            self.random_model.build()
+            self.caches['unlearn'] = TeacherLogitCache.build(self.opt, self.unlearn_teacher, dataset, 'badT_unlearn')
+            # the random teacher is regenerated from its seed if ever needed again
+            self.random_model.release()
+        return super().unlearn(train_loader, test_loader, val_loader)
+
+    def forward_pass(self, sample, target, infgt, index=None):
+        output = self.student(sample)
         
-        # Select which output to use depending from infgt
-        labels = torch.unsqueeze(infgt, 1)
-        overall_teacher_out = labels * u_teacher_out + (1 - labels) * f_teacher_out
+        # Calculate logits (original e random), or look them up in the caches
+        with torch.no_grad():
+            if 'full' in self.caches and index is not None:
+                full_teacher_logits = self.caches['full'].get(index, self.opt.device)
+            else:
+                full_teacher_logits = self.full_teacher(sample)
+            if 'unlearn' in self.caches and index is not None:
+                unlearn_teacher_logits = self.caches['unlearn'].get(index, self.opt.device)
+            else:
+                unlearn_teacher_logits = self.unlearn_teacher(sample)
         
-        # Calculate loss with KL-divergence
-        student_out = F.log_softmax(output / self.kltemp, dim=1)
-        loss = F.kl_div(student_out, overall_teacher_out)
+        # KL-divergence towards the teacher selected by infgt
+        loss = teacher_mix_kl_loss(output, full_teacher_logits, unlearn_teacher_logits, infgt, self.kltemp)
         return output,loss
 
 
@@ -61,17 +92,18 @@ class BadT(BaseUnlearningMethod):
     def train_one_epoch(self, loader):
             self.model.train()  # Set the model in training mode
 
-            for inputs, labels, infgt in tqdm.tqdm(loader):
-                inputs, labels, infgt = inputs.to(self.opt.device), labels.to(self.opt.device), infgt.to(self.opt.device)
-                with autocast(): 
+            for inputs, labels, infgt, *extra in tqdm.tqdm(loader):
+                with autocast(self.opt.device): 
                     # reset gradients
                     self.optimizer.zero_grad()
-                    # Execute the forward pass
-                    preds, loss = self.forward_pass(inputs, labels, infgt)
+                    # Execute the forward and backward pass, optionally split in microbatches
+                    preds, loss = accumulate_gradients(
+                        lambda x, y, f, *e: self.forward_pass(x.to(self.opt.device), y.to(self.opt.device), f.to(self.opt.device), *e),
+                        (inputs, labels, infgt, *extra), self.opt.train.microbatch_size, self.scaler)
+                    average_gradients(self.model.parameters())  # data parallel over the ranks, if any
                     self.logger.log_metrics({"method":"BadT", "loss": loss.item()}, step=self.curr_step)
-                    self.scaler.scale(loss).backward()  # forward pass and backpropagation
                     self.scaler.step(self.optimizer) #update weights
                     self.scaler.update() # update scaler
-            self.scheduler.step(loss) # update learning rate
+            self.scheduler.step(all_reduce_sum(loss.detach().clone()) / get_world_size()) # update learning rate, with the same loss on every rank
             print(f'Epoch: {self.epoch}')
             return
@@ -1,7 +1,5 @@
 import torch
 from abc import ABC, abstractmethod
-from torch.cuda.amp import GradScaler
-from torch.cuda.amp import autocast
 import numpy as np
 import torchmetrics
 import copy
@@ -9,8 +7,11 @@ import json
 import tqdm
 import time
 import os
-from src.metrics.metrics import compute_metrics
+from src.metrics.metrics import compute_metrics, RetainForgetAccuracy
 from src.utils import LinearLR
+from src.training import accumulate_gradients
+from src.distributed import average_gradients
+from src.device import autocast, grad_scaler
 
 
 class BaseUnlearningMethod(ABC):
@@ -20,7 +21,7 @@ class BaseUnlearningMethod(ABC):
         self.optimizer = torch.optim.SGD(self.model.parameters(), lr=0.0025)
         if forgetting_set is not None:
             self.forgetting_subset = forgetting_set
-        self.scaler = GradScaler()  # mixed precision
+        self.scaler = grad_scaler(opt.device)  # mixed precision
         self.save_files = {"train_time_taken": 0} 
         self.curr_step = 0
         # optional prenet
@@ -44,7 +45,7 @@ class BaseUnlearningMethod(ABC):
         """Single step of training."""
         inputs, labels = inputs.to(self.opt.device), labels.to(self.opt.device)
     
-        with torch.cuda.amp.autocast():
+        with autocast(self.opt.device):
             outputs = self.model(inputs)
             loss = torch.nn.functional.cross_entropy(outputs, labels)
 
@@ -71,15 +72,17 @@ class BaseUnlearningMethod(ABC):
     def train_one_epoch(self, loader):
         self.model.train()  
         # For each batch in the loader
-        for inputs, labels in tqdm.tqdm(loader):
-            inputs, labels = inputs.to(self.opt.device), labels.to(self.opt.device)
-            with autocast(): 
+        # extra items (e.g. the sample index of an IndexedDataset) are forwarded to forward_pass
+        for inputs, labels, *extra in tqdm.tqdm(loader):
+            with autocast(self.opt.device): 
                 # Zero the gradients
                 self.optimizer.zero_grad()
-                # Forward pass
-                preds, loss = self.forward_pass(inputs, labels)
+                # Forward and backward pass, optionally split in microbatches moved to the device one at a time
+                preds, loss = accumulate_gradients(
+                    lambda x, y, *e: self.forward_pass(x.to(self.opt.device), y.to(self.opt.device), *e),
+                    (inputs, labels, *extra), self.opt.train.microbatch_size, self.scaler)
+                average_gradients(self.model.parameters())  # data parallel over the ranks, if any
                 self.logger.log_metrics({"method":self.opt.unlearning_method, "loss": loss.item()}, step=self.curr_step)
-                self.scaler.scale(loss).backward()  # Backward pass
                 self.scaler.step(self.optimizer) # Update the weights
                 self.scaler.update() # Update the scaler
                 self.curr_step += 1
@@ -91,10 +94,7 @@ class BaseUnlearningMethod(ABC):
         """Evaluate a model basing on difference between retain and forget accuracy"""
         self.model.eval()   
         self.top1 = -1  # Reset top1
-        correct_retain=0
-        correct_forget=0
-        total_retain=0
-        total_forget=0
+        accuracy = RetainForgetAccuracy(self.opt.dataset.classes, self.forgetting_subset, self.opt.device)
 
         if save_preds:
             preds, targets = [], []  # Lists to store predictions and targets
@@ -106,22 +106,14 @@ class BaseUnlearningMethod(ABC):
                 output = self.model(images) if self.prenet is None else self.model(self.prenet(images))  # Forward pass
 
                 # Compute accuracy
-                _, preds = torch.max(output, 1)
-                for t, p in zip(target, preds):
-                    if t in self.forgetting_set:
-                        if p==t:
-                            correct_forget+=1
-                        total_forget+=1
-                    else:
-                        if p==t:
-                            correct_retain+=1
-                        total_retain+=1
+                accuracy.update(output, target)
 
                 if save_preds: 
                     preds.append(output.cpu().numpy())
                     targets.append(target.cpu().numpy())
 
-        top1 = (correct_retain/total_retain) - (correct_forget/total_forget)
+        metrics = accuracy.compute()
+        top1 = metrics['accuracy_retaining'] - metrics['accuracy_forgetting']
         self.top1 = -1
 
         if not save_preds:
@@ -144,29 +136,17 @@ class BaseUnlearningMethod(ABC):
     def validate(self, val_loader):
         print("Start validation")
         self.model.eval()  
-        correct_forget = 0
-        total_forget = 0
-        correct_retain = 0
-        total_retain = 0
+        accuracy = RetainForgetAccuracy(self.opt.dataset.classes, self.forgetting_subset, self.opt.device)
 
         with torch.no_grad():  # Disable gradient calculation
 
             for inputs, targets in val_loader:
                 inputs, targets = inputs.to(self.opt.device), targets.to(self.opt.device)
-                outputs = self.model(inputs)
-                for o, t in zip(outputs, targets):
-                    pred = torch.argmax(o)
-                    if t in self.forgetting_subset:
-                        if pred==t:
-                            correct_forget+=1
-                        total_forget+=1
-                    else:
-                        if pred==t:
-                            correct_retain+=1
-                    total_retain+=1
+                accuracy.update(self.model(inputs), targets)
         
-        accuracy_retain = correct_retain / total_retain
-        accuracy_forget = correct_forget / total_forget
+        metrics = accuracy.compute()
+        accuracy_retain = metrics['accuracy_retaining']
+        accuracy_forget = metrics['accuracy_forgetting']
 
         # Logging on WandB
         self.logger.log_metrics({
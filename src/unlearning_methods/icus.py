@@ -111,7 +111,6 @@ class Icus(BaseUnlearningMethod):
     def __init__(self, opt, model, input_dim, nclass, wrapped_train_loader, forgetting_subset, logger):
         super().__init__(opt, model)
         self.opt=opt
-        self.orig_model = copy.deepcopy(self.model)
         self.wrapped_train_loader = wrapped_train_loader
         self.logger = logger
         self.description = wrapped_train_loader.dataset.descr
@@ -162,7 +161,6 @@ class Icus(BaseUnlearningMethod):
         running_loss = 0.0
         start=time.time()
         for batch in unlearning_train:
-            torch.cuda.empty_cache()
             targets, weights, descr, _ = batch
             weights, descr, targets = weights.to(self.device), descr.to(self.device), targets.to(self.device)
             
@@ -0,0 +1,82 @@
+import copy
+import torch
+import torch.nn as nn
+
+
+def reference_dtype(name, device):
+    """Storage dtype of the frozen reference models, half precision falls back to bfloat16 on cpu."""
+    dtype = getattr(torch, name)
+    if dtype == torch.float16 and torch.device(device).type == 'cpu':
+        # float16 convolutions are not implemented on every cpu, bfloat16 ones are
+        return torch.bfloat16
+    return dtype
+
+
+def _freeze(model, dtype, device):
+    model = model.to(device=device, dtype=dtype).eval()
+    for param in model.parameters():
+        param.requires_grad = False
+    return model
+
+
+class ReferenceModel(nn.Module):
+    def __init__(self, model, dtype=torch.float16, device='cpu'):
+        """
+        Frozen copy of a model, stored once in reduced precision and used as teacher by the unlearning methods.
+        Inputs are cast to the storage dtype, outputs are returned in float32.
+        Args:
+            model (nn.Module): model to copy.
+            dtype (torch.dtype): storage dtype, see reference_dtype.
+            device (str): device of the copy.
+        """
+        super().__init__()
+        self.dtype = dtype
+        self.device = device
+        self.model = _freeze(copy.deepcopy(model), dtype, device)
+
+    def train(self, mode=True):
+        # the reference is frozen, batch norm always uses the running statistics
+        return super().train(False)
+
+    def _forward(self, x):
+        # autocast would cast the stored weights again at every call
+        with torch.no_grad(), torch.autocast(device_type=torch.device(self.device).type, enabled=False):
+            return self.model(x.to(self.device, self.dtype)).float()
+
+    def forward(self, x):
+        return self._forward(x)
+
+
+class RandomReferenceModel(ReferenceModel):
+    def __init__(self, reference, init_fn, seed=0):
+        """
+        Randomly initialised teacher, generated from a seed on first use and dropped by release().
+        Modules left untouched by init_fn (e.g. batch norm) keep the state of the reference.
+        Args:
+            reference (ReferenceModel): reference the architecture and the remaining state are copied from.
+            init_fn (callable): applied to every module to re-initialise its weights.
+            seed (int): seed of the initialisation, the same teacher is regenerated after a release.
+        """
+        nn.Module.__init__(self)
+        self.dtype = reference.dtype
+        self.device = reference.device
+        self.init_fn = init_fn
+        self.seed = seed
+        self._reference = [reference]  # not registered as a submodule, its weights are stored only once
+        self.model = None
+
+    def build(self):
+        if self.model is None:
+            # initialised on cpu in float32, so that the weights only depend on the seed
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(self.seed)
+                model = copy.deepcopy(self._reference[0].model).to('cpu', torch.float32)
+                model.apply(self.init_fn)
+            self.model = _freeze(model, self.dtype, self.device)
+        return self
+
+    def release(self):
+        self.model = None
+
+    def forward(self, x):
+        return self.build()._forward(x)
@@ -1,5 +1,5 @@
 import torch
-import time, copy
+import time
 import torch.nn as nn
 import tqdm
 import numpy as np
@@ -9,23 +9,35 @@ from torch.nn import functional as F
 from src.metrics.metrics import compute_metrics
 from src.utils import LinearLR
 from src.unlearning_methods.base import BaseUnlearningMethod
+from src.unlearning_methods.teacher_cache import TeacherLogitCache
+from src.unlearning_methods.reference import ReferenceModel, reference_dtype
+from src.models.partial import SuffixModel
+from src.loss.loss import distill_kl_loss
 
 class Scrub(BaseUnlearningMethod):
 
     def __init__(self, opt, model, forgetting_subset, logger, alpha=0.1, kd_T=1.0):
         super().__init__(opt, model)
-        self.og_model = copy.deepcopy(model)  # original model copy
+        # frozen original model copy, stored in reduced precision
+        self.og_model = ReferenceModel(model, reference_dtype(opt.unlearn.reference_dtype, opt.device), opt.device)
+        self.student, self.teacher = self.model, self.og_model
+        if opt.unlearn.trainable_blocks is not None:
+            # only the last blocks are trained, the loaders yield the cached activations of the frozen prefix
+            self.student = SuffixModel(self.model, opt.unlearn.trainable_blocks)
+            self.teacher = SuffixModel(self.og_model, opt.unlearn.trainable_blocks)
         self.forgetting_subset = forgetting_subset
         self.opt=opt
         self.criterion = nn.CrossEntropyLoss()
         self.logger = logger
         self.alpha = alpha
         self.kd_T = kd_T
-        self.optimizer = torch.optim.SGD(self.model.parameters(), lr=opt.unlearn.lr, momentum=0.9, weight_decay=0.001)
+        self.optimizer = torch.optim.SGD(self.student.parameters(), lr=opt.unlearn.lr, momentum=0.9, weight_decay=0.001)
         self.scheduler = optim.lr_scheduler.StepLR(self.optimizer, step_size=5, gamma=0.1)
         self.msteps = opt.unlearn.scrub_steps//2 
         self.save_files = {"train_time_taken": 0, "val_top1": []}
         self.curr_step = 0  
+        self.caches = {}
+        self.cache = None
 
     def unlearn(self, retain_loader, forget_loader, val_loader=None):
         print("Start unlearning process")
@@ -33,6 +45,10 @@ class Scrub(BaseUnlearningMethod):
             self.val_loader = val_loader
         self.curr_step = 0
         self.epoch = 0
+        if self.opt.unlearn.teacher_cache.enabled:
+            # the teacher is frozen, its logits are computed once instead of at every step
+            self.caches = {'forget': TeacherLogitCache.build(self.opt, self.teacher, forget_loader.dataset, 'scrub_forget'),
+                           'retain': TeacherLogitCache.build(self.opt, self.teacher, retain_loader.dataset, 'scrub_retain')}
 
         while self.epoch < self.opt.unlearn.scrub_steps:
             print(f"Epoch {self.epoch}")
@@ -49,31 +65,27 @@ class Scrub(BaseUnlearningMethod):
         return self.model
             
 
-    def distill_kl_loss(self, student_output, teacher_output, temperature):
-        """Calculate the KL-divergence loss for knowledge distillation."""
-        student_output = F.log_softmax(student_output / temperature, dim=1)
-        teacher_output = F.softmax(teacher_output / temperature, dim=1)
-        loss = F.kl_div(student_output, teacher_output, reduction='sum')
-        loss = loss * (temperature ** 2) / student_output.shape[0]
-        return loss
-
     def _train_one_phase(self, loader):
+        self.cache = self.caches.get('forget' if self.maximize else 'retain')
         time_start = time.process_time()
         self.train_one_epoch(loader=loader)
         self.save_files['train_time_taken'] += time.process_time() - time_start
         self.epoch += 1
 
 
-    def forward_pass(self, inputs, target):
+    def forward_pass(self, inputs, target, index=None):
         inputs, target = inputs.to(self.opt.device), target.to(self.opt.device)        
         # Forward pass (with gradients)
-        output = self.model(inputs)
-        # Forward pass (without gradients)
-        with torch.no_grad():
-            logit_t = self.og_model(inputs)
+        output = self.student(inputs)
+        # Forward pass (without gradients), or lookup of the cached teacher logits
+        if self.cache is not None and index is not None:
+            logit_t = self.cache.get(index, self.opt.device)
+        else:
+            with torch.no_grad():
+                logit_t = self.teacher(inputs)
         # Calculate loss: standard (cross-entropy) + distillation (KL-divergence)
         loss = F.cross_entropy(output, target)
-        loss += self.alpha * self.distill_kl_loss(output, logit_t, self.kd_T)
+        loss += self.alpha * distill_kl_loss(output, logit_t, self.kd_T)
         if self.maximize:
             loss = -loss
         
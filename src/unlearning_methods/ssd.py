@@ -1,7 +1,7 @@
+import os
 import torch, copy, time
 import torch.nn as nn
 from src.utils import ssd_tuning
-from torch.cuda.amp import autocast, GradScaler
 import numpy as np
 from torch.nn import functional as F
 from src.unlearning_methods.base import BaseUnlearningMethod
@@ -18,8 +18,15 @@ class SSD(BaseUnlearningMethod):
         self.model=model
         self.opt.train_iters = len(wrapped_train_loader) + len(forget_loader)
         time_start = time.process_time()
+        cache_path = None
+        if self.opt.unlearn.importance_cache.enabled:
+            cache_dir = os.path.join(self.opt.currentDir, self.opt.cache.path, 'ssd_importances')
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_path = os.path.join(cache_dir, f'{self.opt.dataset.name}_resize{self.opt.dataset.resize}')
         # Call the SSD tuning method to modify the model
-        self.best_model = ssd_tuning(self.model, forget_loader, self.opt.unlearn.SSDdampening, self.opt.unlearn.SSDselectwt, wrapped_train_loader, self.opt.device)
+        self.best_model = ssd_tuning(self.model, forget_loader, self.opt.unlearn.SSDdampening, self.opt.unlearn.SSDselectwt, wrapped_train_loader, self.opt.device,
+                                     cache_path, np.dtype(self.opt.unlearn.importance_cache.dtype),
+                                     self.opt.unlearn.ssd_min_layer, self.opt.unlearn.ssd_max_layer, self.opt.unlearn.ssd_module_paths)
         self.save_files['train_time_taken'] += time.process_time() - time_start
         self.opt.train_iters = actual_iters
         return self.best_model
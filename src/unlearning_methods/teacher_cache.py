@@ -0,0 +1,83 @@
+import os
+import hashlib
+import numpy as np
+import torch
+import tqdm
+from src.utils import state_dict_hash
+from src.datasets.dataset import get_dataloader, dataset_fingerprint
+from src.distributed import main_process_first
+
+
+class TeacherLogitCache:
+    def __init__(self, path):
+        """
+        Memory-mapped logits of a frozen teacher, indexed by the sample index of the dataset they were computed on.
+        Dense caches store [N, C] logits, top-k caches store the k largest logits and their classes,
+        the other logits are restored as -inf (zero probability).
+        Args:
+            path (str): cache file prefix.
+        """
+        self.values = np.load(path + '_values.npy', mmap_mode='r')
+        self.classes = np.load(path + '_classes.npy', mmap_mode='r') if os.path.exists(path + '_classes.npy') else None
+        self.num_classes = int(np.load(path + '_meta.npy')[0])
+
+    def get(self, index, device):
+        index = index.cpu().numpy()
+        values = torch.from_numpy(np.asarray(self.values[index])).to(device, torch.float32)
+        if self.classes is None:
+            return values
+        logits = torch.full((len(index), self.num_classes), float('-inf'), device=device)
+        classes = torch.from_numpy(np.asarray(self.classes[index])).to(device, torch.long)
+        return logits.scatter_(1, classes, values)
+
+    @classmethod
+    def build(cls, cfg, teacher, dataset, name):
+        """
+        Compute the teacher logits over an IndexedDataset in one pass, or reuse them if already cached.
+        Args:
+            cfg (DictConfig): hydra config, see cfg.unlearn.teacher_cache.
+            teacher (nn.Module): frozen teacher.
+            dataset (IndexedDataset): dataset whose items end with the sample index.
+            name (str): name of the cache, e.g. the teacher role.
+        """
+        dtype = np.dtype(cfg.unlearn.teacher_cache.dtype)
+        topk = cfg.unlearn.teacher_cache.topk
+        # in partial mode the teacher runs over the prefix activations, which depend on the split and their precision
+        partial = f'{cfg.unlearn.trainable_blocks}_{cfg.unlearn.activation_dtype}'
+        key = hashlib.sha1(f'{state_dict_hash(teacher)}_{dataset_fingerprint(dataset)}_{cfg.dataset.resize}_{dtype}_{topk}_{partial}'.encode()).hexdigest()[:16]
+        cache_dir = os.path.join(cfg.currentDir, cfg.cache.path, 'teacher_logits')
+        path = os.path.join(cache_dir, f'{cfg.dataset.name}_{name}_{key}')
+        with main_process_first():
+            if not os.path.exists(path + '_meta.npy'):
+                os.makedirs(cache_dir, exist_ok=True)
+                _write_logits(cfg, teacher, dataset, name, path, dtype, topk)
+        return cls(path)
+
+
+def _write_logits(cfg, teacher, dataset, name, path, dtype, topk):
+    # one pass of the teacher over the dataset, the logits are stored at the sample index
+    num_classes = cfg.dataset.classes
+    width = num_classes if topk is None else topk
+    values = np.lib.format.open_memmap(path + '_values.npy', mode='w+', dtype=dtype, shape=(len(dataset), width))
+    classes = None
+    if topk is not None:
+        classes = np.lib.format.open_memmap(path + '_classes.npy', mode='w+', dtype=np.int16, shape=(len(dataset), topk))
+
+    device = cfg.device
+    teacher.eval()
+    loader = get_dataloader(cfg, dataset)
+    with torch.no_grad():
+        for batch in tqdm.tqdm(loader, desc=f'Caching {name} teacher logits'):
+            inputs, index = batch[0].to(device), batch[-1].numpy()
+            logits = teacher(inputs).float()
+            if topk is None:
+                values[index] = logits.cpu().numpy().astype(dtype)
+            else:
+                top = logits.topk(topk, dim=1)
+                values[index] = top.values.cpu().numpy().astype(dtype)
+                classes[index] = top.indices.cpu().numpy().astype(np.int16)
+    values.flush()
+    if classes is not None:
+        classes.flush()
+    # the meta file is written last, it marks the cache as complete
+    np.save(path + '_meta.npy', np.asarray([num_classes]))
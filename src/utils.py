@@ -1,7 +1,8 @@
 import os
+import hashlib
 from pytorch_lightning.callbacks.early_stopping import EarlyStopping
 from pytorch_lightning.callbacks import ModelCheckpoint
-from torch.utils.data import Subset
+from torch.utils.data import Subset, IterableDataset
 import torch
 from torch.optim.lr_scheduler import _LRScheduler
 from typing import Dict, List
@@ -10,6 +11,8 @@ import tqdm
 import torch.nn as nn
 import numpy as np
 import omegaconf
+from src.datasets.dataset import get_class_index, dataset_fingerprint
+from src.distributed import main_process_first
 
 def get_save_model_callback(save_path):
     save_model_callback = ModelCheckpoint(
@@ -30,6 +33,18 @@ def get_early_stopping(patience=10):
     )
     return early_stopping_callback
 
+def state_dict_hash(model, exclude=None):
+    """Hash of the weights and buffers of a model, used to key the caches computed from a checkpoint.
+    The tensors of the exclude submodule, if any, are left out."""
+    excluded = {tensor.data_ptr() for tensor in exclude.state_dict().values()} if exclude is not None else set()
+    h = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        if tensor.data_ptr() in excluded:
+            continue
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()[:16]
+
 # forgetting_set could be a list or a string
 def get_forgetting_subset(forgetting_set, n_classes, forgetting_set_size):
     
@@ -46,20 +61,15 @@ def get_forgetting_subset(forgetting_set, n_classes, forgetting_set_size):
     
         
 def get_retain_and_forget_datasets(full_dataset, forgetting_subset, forgetting_set_size, class_forget=None):
-    all_indices = np.arange(len(full_dataset))
-    all_labels = np.array([full_dataset[i][1] for i in all_indices])
-    
-    # find indexes of the classes to forget
-    forget_indices = []
-    for class_idx in forgetting_subset:
-        class_indices = np.where(all_labels == class_idx)[0]
-        forget_indices.extend(class_indices)  # add all the indices of the class to forget
+    # retain and forget indices are gathered from the class index of the dataset
+    retain_indices, forget_indices = get_class_index(full_dataset).split(forgetting_subset)
 
-    # avoid duplicates
-    forget_indices = list(set(forget_indices))
+    # streaming datasets cannot be indexed, they are filtered by class while being read
+    if isinstance(full_dataset, IterableDataset):
+        retain_dataset = full_dataset.select(drop_classes=forgetting_subset)
+        forget_dataset = full_dataset.select(keep_classes=forgetting_subset)
+        return retain_dataset, forget_dataset, forget_indices
 
-    # find indexes of the classes to retain
-    retain_indices = list(set(all_indices) - set(forget_indices))
     # create the datasets
     forget_dataset = Subset(full_dataset, forget_indices)
     retain_dataset = Subset(full_dataset, retain_indices)
@@ -76,6 +86,66 @@ def get_numbers_from_superclass(target_number, data):
 
 
 ################## STUFF FOR SSD TAKEN FROM CORRECTIVE MACHINE UNLEARNING PAPER ####################
+
+class FlatImportances:
+    def __init__(self, parameters, device=None):
+        """
+        Importances of a set of parameters, stored in a single preallocated flat float32 buffer.
+        Args:
+            parameters (dict): name -> parameter, see ParameterPerturber.selected_parameters.
+            device (str): device of the buffer, the one of the parameters if None.
+        """
+        self.names = list(parameters)
+        self.parameters = list(parameters.values())
+        device = device if device is not None else self.parameters[0].device
+        self.flat = torch.zeros(sum(p.numel() for p in self.parameters), device=device)
+        self.views = [view.view_as(p) for view, p in zip(self.flat.split([p.numel() for p in self.parameters]), self.parameters)]
+
+    def accumulate(self):
+        """Add the squared gradients of the parameters to the buffer with one multi-tensor op."""
+        pairs = [(view, p.grad.float()) for view, p in zip(self.views, self.parameters) if p.grad is not None]
+        if pairs:
+            views, grads = map(list, zip(*pairs))
+            torch._foreach_addcmul_(views, grads, grads)
+
+    def as_dict(self):
+        return dict(zip(self.names, self.views))
+
+
+def flat_importances(importances):
+    """
+    Flat buffer behind an importance dict whose values are consecutive views of one tensor, as returned by
+    FlatImportances.as_dict and load_importances; other dicts are concatenated.
+    """
+    views = list(importances.values())
+    base = views[0]._base
+    offset = 0
+    for view in views:
+        if base is None or view._base is not base or view.data_ptr() != base.data_ptr() + offset * base.element_size():
+            return torch.cat([v.reshape(-1) for v in views])
+        offset += view.numel()
+    return base if offset == base.numel() else torch.cat([v.reshape(-1) for v in views])
+
+
+def ssd_dampen_(parameters, original, forget, selection_weighting, dampening_constant, exponent=1, lower_bound=1):
+    """
+    SSD synapse selection and dampening, as a single masked multiply over flat importance buffers.
+    Args:
+        parameters (list): parameters to dampen, in the order of the buffers.
+        original (torch.Tensor): flat full set importances.
+        forget (torch.Tensor): flat forget set importances.
+        selection_weighting (float): alpha, parameters with forget > alpha * original are selected.
+        dampening_constant (float): lambda, selected parameters are scaled by (lambda * original / forget) ** exponent.
+        exponent (float): exponent of the dampening factor.
+        lower_bound (float): upper bound of the dampening factor, 1 prevents parameter values from increasing.
+    """
+    with torch.no_grad():
+        factor = original.mul(dampening_constant).div(forget).pow(exponent).clamp(max=lower_bound)
+        factor = torch.where(forget > original.mul(selection_weighting), factor, torch.ones_like(factor))
+        factors = [f.view_as(p) for f, p in zip(factor.split([p.numel() for p in parameters]), parameters)]
+        torch._foreach_mul_(list(parameters), factors)
+
+
 class ParameterPerturber:
     def __init__(
         self,
@@ -96,14 +166,38 @@ class ParameterPerturber:
         self.magnitude_diff = parameters["magnitude_diff"]  # unused
         self.min_layer = parameters["min_layer"]
         self.max_layer = parameters["max_layer"]
+        self.module_paths = parameters.get("module_paths")
         self.forget_threshold = parameters["forget_threshold"] #unused
         self.dampening_constant = parameters["dampening_constant"] #lambda 
         self.selection_weighting = parameters["selection_weighting"] #alpha
 
+    def selected_parameters(self) -> Dict[str, torch.nn.Parameter]:
+        """
+        Parameters inside the layer range, in named_parameters order.
+        Layers are the modules owning parameters, in order: min_layer and max_layer are inclusive indices
+        among them (-1 leaves the bound open), module_paths optionally keeps only the given module path prefixes.
+        """
+        named_parameters = list(self.model.named_parameters())
+        layers = list(dict.fromkeys(name.rpartition(".")[0] for name, _ in named_parameters))
+        first = self.min_layer if self.min_layer >= 0 else 0
+        last = self.max_layer if self.max_layer >= 0 else len(layers) - 1
+        in_range = set(layers[first:last + 1])
+        selected = {}
+        for name, p in named_parameters:
+            layer = name.rpartition(".")[0]
+            if layer not in in_range:
+                continue
+            if self.module_paths and not any(layer == path or layer.startswith(path + ".") for path in self.module_paths):
+                continue
+            selected[name] = p
+        if not selected:
+            raise ValueError("The SSD layer range does not select any parameter")
+        return selected
+
     def zerolike_params_dict(self, model: torch.nn) -> Dict[str, torch.Tensor]:
         """
         Taken from: Avalanche: an End-to-End Library for Continual Learning - https://github.com/ContinualAI/avalanche
-        Returns a dict like named_parameters(), with zeroed-out parameter valuse
+        Returns a dict like named_parameters(), with zeroed-out parameter valuse, for the parameters in the layer range
         Parameters:
         model (torch.nn): model to get param dict from
         Returns:
@@ -112,7 +206,7 @@ class ParameterPerturber:
         return dict(
             [
                 (k, torch.zeros_like(p, device=p.device))
-                for k, p in model.named_parameters()
+                for k, p in self.selected_parameters().items()
             ]
         )
 
@@ -127,41 +221,29 @@ class ParameterPerturber:
         importances (dict(str, torch.Tensor([]))): named_parameters-like dictionary containing list of importances for each parameter
         """
         criterion = nn.CrossEntropyLoss()
-        importances = self.zerolike_params_dict(self.model)
-        if forget==False:
-            for (x, y, _) in tqdm.tqdm(dataloader):
-                x, y = x.to(self.device), y.to(self.device)
-                self.opt.zero_grad()
-                
-                out = self.model(x)
-                loss = criterion(out, y)
-                loss.backward()
-
-                for (k1, p), (k2, imp) in zip(
-                    self.model.named_parameters(), importances.items()
-                ):
-                    if p.grad is not None:
-                        imp.data += p.grad.data.clone().pow(2)
-        else:
-            for (x, y) in tqdm.tqdm(dataloader):
+        selected = self.selected_parameters()
+        importances = FlatImportances(selected, self.device)
+        # parameters outside the layer range do not require gradients, the backward pass stops at the first selected layer
+        requires_grad = {name: p.requires_grad for name, p in self.model.named_parameters()}
+        for name, p in self.model.named_parameters():
+            p.requires_grad = name in selected
+        try:
+            # full set batches also carry the forget flag
+            for (x, y, *_) in tqdm.tqdm(dataloader):
                 x, y = x.to(self.device), y.to(self.device)
                 self.opt.zero_grad()
                 
                 out = self.model(x)
                 loss = criterion(out, y)
                 loss.backward()
-
-                for (k1, p), (k2, imp) in zip(
-                    self.model.named_parameters(), importances.items()
-                ):
-                    if p.grad is not None:
-                        imp.data += p.grad.data.clone().pow(2)
-
+                importances.accumulate()
+        finally:
+            for name, p in self.model.named_parameters():
+                p.requires_grad = requires_grad[name]
 
         # average over mini batch length
-        for _, imp in importances.items():
-            imp.data /= float(len(dataloader))
-        return importances
+        importances.flat /= float(len(dataloader))
+        return importances.as_dict()
 
     def modify_weight(
         self,
@@ -180,25 +262,63 @@ class ParameterPerturber:
 
         """
 
-        with torch.no_grad():
-            for (n, p), (oimp_n, oimp), (fimp_n, fimp) in zip(
-                self.model.named_parameters(),
-                original_importance.items(),
-                forget_importance.items(),
-            ):
-                # Synapse Selection with parameter alpha
-                oimp_norm = oimp.mul(self.selection_weighting)
-                locations = torch.where(fimp > oimp_norm)
-
-                # Synapse Dampening with parameter lambda
-                weight = ((oimp.mul(self.dampening_constant)).div(fimp)).pow(
-                    self.exponent
-                )
-                update = weight[locations]
-                # Bound by 1 to prevent parameter values to increase.
-                min_locs = torch.where(update > self.lower_bound)
-                update[min_locs] = self.lower_bound
-                p[locations] = p[locations].mul(update)
+        params = dict(self.model.named_parameters())
+        # only the parameters in the layer range have importances
+        names = list(original_importance)
+        original = flat_importances(original_importance)
+        forget = flat_importances({n: forget_importance[n] for n in names})
+        ssd_dampen_([params[n] for n in names], original, forget, self.selection_weighting,
+                    self.dampening_constant, self.exponent, self.lower_bound)
+
+
+def save_importances(importances, path, dtype=np.float32):
+    """Store an importance dictionary as a single flat .npy array, in named_parameters order."""
+    total = sum(imp.numel() for imp in importances.values())
+    flat = np.lib.format.open_memmap(path + '.tmp.npy', mode='w+', dtype=dtype, shape=(total,))
+    start = 0
+    for imp in importances.values():
+        flat[start:start + imp.numel()] = imp.detach().reshape(-1).float().cpu().numpy().astype(dtype)
+        start += imp.numel()
+    flat.flush()
+    del flat
+    os.replace(path + '.tmp.npy', path + '.npy')
+
+
+def load_importances(parameters, path, device):
+    """Load an importance dictionary stored by save_importances, as views of a single flat buffer."""
+    flat = np.load(path + '.npy', mmap_mode='r')
+    if sum(p.numel() for p in parameters.values()) != len(flat):
+        raise ValueError(f"Importance cache {path} does not match the model parameters")
+    # one flat buffer, the importances are views of it as with FlatImportances
+    flat = torch.from_numpy(np.array(flat, dtype=np.float32)).to(device)
+    views = flat.split([p.numel() for p in parameters.values()])
+    return {name: view.view_as(p) for (name, p), view in zip(parameters.items(), views)}
+
+
+def cached_importances(pdr, dataloader, cache_path, dtype=np.float32, forget=False):
+    """
+    Importances over a dataloader, computed once per checkpoint and dataset split and then read from the cache.
+    Args:
+        pdr (ParameterPerturber): perturber of the model.
+        dataloader (DataLoader): loader of the split.
+        cache_path (str): cache file prefix, the hash of the checkpoint, split and batch size is appended.
+        dtype (np.dtype): storage dtype, float16 may flush the smallest importances to zero.
+        forget (bool): see ParameterPerturber.calc_importance.
+    """
+    split = 'forget' if forget else 'full'
+    parameters = pdr.selected_parameters()
+    # the importances are normalized by the number of batches, their scale depends on the batch size
+    key = hashlib.sha1(f'{state_dict_hash(pdr.model)}_{dataset_fingerprint(dataloader.dataset)}_{split}_{list(parameters)}_{dataloader.batch_size}_{len(dataloader)}'.encode()).hexdigest()[:16]
+    path = f'{cache_path}_{split}_{key}'
+    importances = None
+    with main_process_first():
+        if not os.path.exists(path + '.npy'):
+            importances = pdr.calc_importance(dataloader, forget=forget)
+            save_importances(importances, path, dtype)
+    if importances is not None:
+        return importances
+    print(f'Loading cached {split} importances')
+    return load_importances(parameters, path, pdr.device)
 
 
 # default values: 
@@ -223,13 +343,19 @@ def ssd_tuning(
     selection_weighting,
     full_train_dl,
     device,
+    cache_path=None,
+    cache_dtype=np.float32,
+    min_layer=-1,
+    max_layer=-1,
+    module_paths=None,
 ):
     parameters = {
         "lower_bound": 1,
         "exponent": 1,
         "magnitude_diff": None,
-        "min_layer": -1,
-        "max_layer": -1,
+        "min_layer": min_layer,
+        "max_layer": max_layer,
+        "module_paths": module_paths,
         "forget_threshold": 1,
         "dampening_constant": dampening_constant,
         "selection_weighting": selection_weighting,
@@ -243,7 +369,11 @@ def ssd_tuning(
 
     sample_importances = pdr.calc_importance(forget_train_dl, forget=True)
 
-    original_importances = pdr.calc_importance(full_train_dl, forget=False)
+    # the full set importances only depend on the checkpoint and the data, they can be cached across runs
+    if cache_path is not None:
+        original_importances = cached_importances(pdr, full_train_dl, cache_path, cache_dtype, forget=False)
+    else:
+        original_importances = pdr.calc_importance(full_train_dl, forget=False)
     pdr.modify_weight(original_importances, sample_importances)
     return model
  
@@ -1,138 +1,160 @@
 import hydra
 import torch
 import os
+import time
 from torch.optim import AdamW
-from torch.utils.data import DataLoader
 import wandb
 from tqdm import tqdm
-from src.datasets.dataset import load_dataset
+from src.datasets.dataset import load_dataset, get_dataloader, ProgressiveResize
 from src.models.classifier import Classifier
+from src.models.partial import get_feature_dataset
 from src.log import get_loggers
+from src.training import accumulate_gradients, enable_activation_checkpointing, evaluate
+from src.training import EarlyStopper, checkpoint_paths, save_training_state, load_training_state
+from src.device import setup_device, precision_autocast, precision_scaler, synchronize
+from src.distributed import launch, distribute, is_main_process, barrier
 from omegaconf import OmegaConf
 
-@hydra.main(config_path='config', config_name='config')
-def main(cfg):
+def forward_loss(model, criterion, x, y, device):
+    y_pred = model(x.to(device))
+    return y_pred, criterion(y_pred, y.to(device))
+
+
+def run(cfg):
     # Set seed
     if cfg.seed == -1:
         random_data = os.urandom(4)
         seed = int.from_bytes(random_data, byteorder="big")
         cfg.seed = seed
     torch.manual_seed(cfg.seed)    
+    setup_device(cfg)
 
     wandb_logger = get_loggers(cfg) # loggers
 
     # Load dataset
     data_dir = os.path.join(cfg.currentDir, cfg.dataset.path)
-    train, val, test = load_dataset(cfg.dataset.name, data_dir, cfg.dataset.resize)
-    train_loader = DataLoader(train, batch_size=cfg.train.batch_size, shuffle=True, num_workers=cfg.train.num_workers)
-    val_loader = DataLoader(val, batch_size=cfg.train.batch_size, shuffle=False, num_workers=cfg.train.num_workers)
-    test_loader = DataLoader(test, batch_size=cfg.train.batch_size, shuffle=False, num_workers=cfg.train.num_workers)
-
+    train, val, test = load_dataset(cfg.dataset.name, data_dir, cfg.dataset.resize, shared=cfg.dataset.shared_memory)
 
-    model = Classifier(cfg.weights_name, num_classes=cfg.dataset.classes, finetune=True)
+    model = Classifier(cfg.weights_name, num_classes=cfg.dataset.classes, finetune=cfg.train.finetune)
     model.to(cfg.device)
-
-    optimizer = AdamW(model.parameters(), lr=cfg.train.lr)
+    train_model = model
+    if model.backbone_frozen():
+        # only the head is trained, over the features of the frozen backbone extracted once per split
+        train = get_feature_dataset(cfg, model, train, 'train')
+        val = get_feature_dataset(cfg, model, val, 'val')
+        test = get_feature_dataset(cfg, model, test, 'test')
+        train_model = model.get_head()
+    elif cfg.train.activation_checkpointing:
+        enable_activation_checkpointing(model)
+
+    resize_schedule = ProgressiveResize(cfg, train)
+    val_loader = get_dataloader(cfg, val, distributed='eval')
+    test_loader = get_dataloader(cfg, test, distributed='eval')
+
+    optimizer = AdamW(train_model.parameters(), lr=cfg.train.lr)
     criterion = torch.nn.CrossEntropyLoss()
 
-    for epoch in range(cfg.train.max_epochs):
+    precision = cfg.train.precision
+    scaler = precision_scaler(cfg.device, precision)
+
+    save_dir = os.path.join(cfg.currentDir, cfg.train.save_path)
+    os.makedirs(save_dir, exist_ok=True)
+    save_path = os.path.join(save_dir, cfg.dataset.name + '_' + cfg.model + '.pth')
+    best_path, last_path = checkpoint_paths(save_path)
+    stopper = EarlyStopper(cfg.train.monitor, cfg.train.patience)
+    start_epoch = 0
+    if cfg.train.resume and os.path.exists(last_path):
+        start_epoch = load_training_state(last_path, model, optimizer, scaler, stopper, cfg.device)
+    if cfg.train.early_stopping and stopper.stopped:
+        print(f"Training already stopped early, best {stopper.monitor} {stopper.best:.4f} at epoch {stopper.best_epoch+1}")
+        start_epoch = cfg.train.max_epochs
+
+    # data parallel over the ranks, if any, the evaluation runs on the unwrapped module
+    step_model = distribute(train_model)
+
+    for epoch in range(start_epoch, cfg.train.max_epochs):
         print(f"Epoch {epoch+1}/{cfg.train.max_epochs}")
-        model.train()
+        train_loader = resize_schedule.loader(epoch)
+        train_model.train()
         train_loss = 0
+        num_samples, time_start = 0, time.perf_counter()
         for i, (x, y) in enumerate(tqdm(train_loader)):
             optimizer.zero_grad()
-            x = x.to(cfg.device)
-            y = y.to(cfg.device)
-            y_pred = model(x)
-            loss = criterion(y_pred, y)
+            with precision_autocast(cfg.device, precision):
+                _, loss = accumulate_gradients(lambda x, y: forward_loss(step_model, criterion, x, y, cfg.device),
+                                               (x, y), cfg.train.microbatch_size, scaler, getattr(step_model, 'no_sync', None))
             train_loss += loss.item()
-            loss.backward()
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
+            num_samples += len(x)
+        synchronize(cfg.device)
+        throughput = num_samples / (time.perf_counter() - time_start)
+        print(f"Train throughput ({precision}): {throughput:.1f} samples/s")
 
         train_loss /= len(train_loader)
-        wandb_logger.log_metrics({"train_loss": train_loss})
-
-        model.eval()
-        with torch.no_grad():
-            val_loss = 0
-            correct = 0
-            total = 0
-            for i, (x, y) in enumerate(tqdm(val_loader)):
-                x = x.to(cfg.device)
-                y = y.to(cfg.device)
-                y_pred = model(x)
-                loss = criterion(y_pred, y)
-                val_loss += loss.item()
-                _, predicted = y_pred.max(1)
-                total += y.size(0)
-                correct += predicted.eq(y).sum().item()
-
-            val_loss /= len(val_loader)
-            val_acc = 100 * correct / total
-
-            wandb_logger.log_metrics({"val_loss": val_loss, "val_acc": val_acc})
-
-    model.eval()
-    with torch.no_grad():
-        test_loss = 0
-        correct = 0
-        total = 0
-        correct_retain = 0
-        total_retain = 0
-        correct_forget = 0
-        total_forget = 0
-
-        for i, (x, y) in enumerate(tqdm(test_loader)):
-            x = x.to(cfg.device)
-            y = y.to(cfg.device)
-            y_pred = model(x)
-            loss = criterion(y_pred, y)
-            test_loss += loss.item()
-
-            _, predicted = y_pred.max(1)
-
-            # total and correct predictions
-            total += y.size(0)
-            correct += predicted.eq(y).sum().item()
-
-            # filtering retain and forget set
-            for idx in range(y.size(0)):
-                if y[idx].item() in cfg.forgetting_set:
-                    # forget set data
-                    total_forget += 1
-                    if predicted[idx].item() == y[idx].item():
-                        correct_forget += 1
-                else:
-                    # retain set data
-                    total_retain += 1
-                    if predicted[idx].item() == y[idx].item():
-                        correct_retain += 1
-
-        test_loss /= len(test_loader)
-        test_acc = 100 * correct / total
-        retain_acc = 100 * correct_retain / total_retain if total_retain > 0 else 0.0
-        forget_acc = 100 * correct_forget / total_forget if total_forget > 0 else 0.0
-
-        # results logging
-        wandb_logger.log_metrics({
-            "test_loss": test_loss,
-            "test_acc": test_acc,
-            "retain_acc": retain_acc,
-            "forget_acc": forget_acc
-        })
-
-        if cfg.unlearn.update_json == True:
-            with open("src/metrics/metrics.json", "r") as file:
-                data = json.load(file)
-            done = add_case(data, "original_model", str(cfg.forgetting_set), retain_acc, forget_acc)
-            if not done:
-                done = update_case(data, "original_model", str(cfg.forgetting_set), retain_acc, forget_acc)
-            if not done:
-                print("Failed to add/update json")
-
-    #create folder if not exist and save torch model
-    os.makedirs(os.path.join(cfg.currentDir, cfg.train.save_path), exist_ok=True)
-    torch.save(model.state_dict(), os.path.join(cfg.currentDir, cfg.train.save_path, cfg.dataset.name + '_' + cfg.model + '.pth'))
+        wandb_logger.log_metrics({"train_loss": train_loss, "train_throughput": throughput})
+        if resize_schedule.enabled:
+            wandb_logger.log_metrics({"train_resize": resize_schedule.size(epoch)})
+
+        val_loss, metrics = evaluate(train_model, val_loader, criterion, cfg.dataset.classes, device=cfg.device, precision=precision)
+        val_acc = 100 * metrics['accuracy']
+        wandb_logger.log_metrics({"val_loss": val_loss, "val_acc": val_acc})
+
+        # best weights for early stopping and resumable state of the last epoch
+        improved = stopper.step({"val_loss": val_loss, "val_acc": val_acc}, epoch)
+        stopper.stopped = cfg.train.early_stopping and stopper.should_stop
+        if is_main_process():
+            if cfg.train.early_stopping and improved:
+                torch.save(model.state_dict(), best_path)
+            if cfg.train.resume:
+                save_training_state(last_path, epoch, model, optimizer, scaler, stopper)
+        barrier()
+        if stopper.stopped:
+            print(f"Early stopping at epoch {epoch+1}, best {stopper.monitor} {stopper.best:.4f} at epoch {stopper.best_epoch+1}")
+            break
+
+    # the best weights are missing if early stopping was only enabled when resuming
+    if cfg.train.early_stopping and stopper.best_epoch >= 0 and os.path.exists(best_path):
+        model.load_state_dict(torch.load(best_path, map_location=cfg.device))
+        wandb_logger.log_metrics({"best_epoch": stopper.best_epoch + 1})
+
+    test_loss, metrics = evaluate(train_model, test_loader, criterion, cfg.dataset.classes, cfg.forgetting_set, cfg.device, precision)
+    test_acc = 100 * metrics['accuracy']
+    retain_acc = 100 * metrics['accuracy_retaining']
+    forget_acc = 100 * metrics['accuracy_forgetting']
+
+    # results logging
+    wandb_logger.log_metrics({
+        "test_loss": test_loss,
+        "test_acc": test_acc,
+        "retain_acc": retain_acc,
+        "forget_acc": forget_acc
+    })
+
+    if precision != 'fp32':
+        # accuracy parity of the reduced precision evaluation versus fp32
+        _, fp32_metrics = evaluate(train_model, test_loader, criterion, cfg.dataset.classes, cfg.forgetting_set, cfg.device, 'fp32')
+        fp32_acc = 100 * fp32_metrics['accuracy']
+        print(f"Test accuracy {precision}: {test_acc:.2f}%, fp32: {fp32_acc:.2f}%")
+        wandb_logger.log_metrics({"fp32_test_acc": fp32_acc, "precision_acc_gap": test_acc - fp32_acc})
+
+    if cfg.unlearn.update_json == True and is_main_process():
+        with open("src/metrics/metrics.json", "r") as file:
+            data = json.load(file)
+        done = add_case(data, "original_model", str(cfg.forgetting_set), retain_acc, forget_acc)
+        if not done:
+            done = update_case(data, "original_model", str(cfg.forgetting_set), retain_acc, forget_acc)
+        if not done:
+            print("Failed to add/update json")
+
+    # save torch model
+    if is_main_process():
+        torch.save(model.state_dict(), save_path)
+
+
+@hydra.main(config_path='config', config_name='config')
+def main(cfg):
+    launch(run, cfg)
 
 
             
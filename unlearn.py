@@ -6,7 +6,7 @@ import copy
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import SubsetRandomSampler
 from src.models.model import load_model
-from src.datasets.dataset import load_dataset, get_retain_forget_dataloaders
+from src.datasets.dataset import load_dataset, get_retain_forget_dataloaders, get_dataloader, require_map_style
 from src.metrics.metrics import compute_metrics, add_case, update_case
 from src.log import get_loggers
 from src.utils import get_forgetting_subset
@@ -15,45 +15,39 @@ from scripts.plot.pca_tsne import plot_features, plot_features_3d
 from src.unlearning_methods.base import get_unlearning_method
 from src.utils import get_retain_and_forget_datasets
 from src.datasets.unlearning_dataset import UnlearningDataset
-from src.datasets.unlearning_dataset import get_unlearning_dataset
+from src.datasets.unlearning_dataset import get_unlearning_dataset, IndexedDataset
+from src.models.partial import get_activation_dataset
+from src.training import enable_activation_checkpointing
+from src.device import setup_device
+from src.distributed import launch, is_main_process
 from src.models.resnet import ResNet9, ResNet18, ResidualBlock 
 from src.models.classifier import Classifier
 from src.unlearning_methods.icus import Icus, IcusHierarchy
 
 
 
-@hydra.main(config_path='config', config_name='config', version_base=None)
-def main(cfg):
+def run(cfg):
     # Set seed
-    torch.cuda.empty_cache() 
     if cfg.seed == -1:
         random_data = os.urandom(4)
         seed = int.from_bytes(random_data, byteorder="big")
         cfg.seed = seed
     torch.manual_seed(cfg.seed)    
+    setup_device(cfg)
 
     # loggers
     loggers = get_loggers(cfg)
 
     # Load dataset
     data_dir = os.path.join(cfg.currentDir, cfg.dataset.path)
-    train, val, test = load_dataset(cfg.dataset.name, data_dir, cfg.dataset.resize)
+    train, val, test = load_dataset(cfg.dataset.name, data_dir, cfg.dataset.resize, shared=cfg.dataset.shared_memory)
+    # the unlearning methods index the retain and forget samples
+    require_map_style(train, 'Unlearning')
     
     # Data loaders
-    test_loader = torch.utils.data.DataLoader(test, 
-        batch_size=cfg.train.batch_size, 
-        shuffle=False, 
-        num_workers=cfg.train.num_workers)
-
-    train_loader = torch.utils.data.DataLoader(train, 
-        batch_size=cfg.train.batch_size, 
-        shuffle=False, 
-        num_workers=cfg.train.num_workers)
-    
-    val_loader = torch.utils.data.DataLoader(val, 
-        batch_size=cfg.train.batch_size, 
-        shuffle=False, 
-        num_workers=cfg.train.num_workers)
+    test_loader = get_dataloader(cfg, test)
+    train_loader = get_dataloader(cfg, train)
+    val_loader = get_dataloader(cfg, val)
 
     # Load model
     print("Model loading")
@@ -62,6 +56,8 @@ def main(cfg):
     # load model weights
     weights = os.path.join(cfg.currentDir, cfg.train.save_path, cfg.dataset.name + '_' + cfg.model + '.pth')
     model.load_state_dict(torch.load(weights, map_location=cfg.device))
+    if cfg.train.activation_checkpointing:
+        enable_activation_checkpointing(model)
     print("Compute classification metrics")
     num_classes = cfg.dataset.classes
     forgetting_subset = get_forgetting_subset(cfg.forgetting_set, cfg.dataset.classes, cfg.forgetting_set_size)
@@ -70,20 +66,28 @@ def main(cfg):
         print(f'{k}: {v}')
 
     # Plotting
-    pca, shared_limits = plot_features(cfg, model, test_loader, unlearned=False)
-    pca=plot_features_3d(cfg, model, test_loader)
+    if is_main_process():
+        pca, shared_limits = plot_features(cfg, model, test_loader, unlearned=False)
+        pca=plot_features_3d(cfg, model, test_loader)
     
     #prepare datasets for unlearning
     print("Wrapping datasets")
     retain_dataset, forget_dataset, forget_indices = get_retain_and_forget_datasets(train, forgetting_subset, cfg.forgetting_set_size)
     print("Forget indices: ", len(forget_indices))
-    forget_indices_val = [i for i in range(len(val)) if val[i][1] in forgetting_subset]
-    retain_indices = [i for i in range(len(train)) if i not in forget_indices]
+    forget_indices_val = np.flatnonzero(np.isin(val.targets, forgetting_subset))
+    retain_indices = retain_dataset.indices
     
     unlearning_method_name = cfg.unlearning_method
     unlearning_train = get_unlearning_dataset(cfg, unlearning_method_name, model, train, retain_indices, forget_indices, forgetting_subset)
     
     #retain and forget set loaders
+    if unlearning_method_name == 'scrub' and cfg.unlearn.trainable_blocks is not None:
+        # only the last blocks are trained, over the cached activations of the frozen prefix
+        retain_dataset = get_activation_dataset(cfg, model, retain_dataset, 'scrub_retain')
+        forget_dataset = get_activation_dataset(cfg, model, forget_dataset, 'scrub_forget')
+    if unlearning_method_name == 'scrub' and cfg.unlearn.teacher_cache.enabled:
+        # samples carry their index, to look up the cached teacher logits
+        retain_dataset, forget_dataset = IndexedDataset(retain_dataset), IndexedDataset(forget_dataset)
     retain_loader, forget_loader = get_retain_forget_dataloaders(cfg, retain_dataset, forget_dataset)
     
     # unlearning process
@@ -102,28 +106,29 @@ def main(cfg):
             weights = os.path.join(cfg.currentDir, cfg.train.save_path, cfg.dataset.name + '_forgetting_set_'+str(cfg.unlearn.already_forgotten_classes)+'_ssd_' + cfg.model + '.pth')
             model.load_state_dict(torch.load(weights, map_location=cfg.device))
         
-        labels = np.array(train.targets)
-        indices = np.where(~np.isin(labels, cfg.unlearn.already_forgotten_classes))[0]
+        indices = train.class_index.retain_indices(cfg.unlearn.already_forgotten_classes)
         filtered_train = Subset(train, indices)
         retain_dataset, forget_dataset, forget_indices = get_retain_and_forget_datasets(filtered_train, cfg.forgetting_set, 1)
         unlearning_train = UnlearningDataset(filtered_train, forget_indices)
-        unlearning_train = torch.utils.data.DataLoader(unlearning_train, batch_size=cfg.train.batch_size, num_workers=8)
-        retain_loader, forget_loader = get_retain_forget_dataloaders(cfg, retain_dataset, forget_dataset)
+        unlearning_train = get_dataloader(cfg, unlearning_train)
+        retain_loader, forget_loader = get_retain_forget_dataloaders(cfg, retain_dataset, forget_dataset, distributed=None)
         new_model = unlearning_method.unlearn(model, unlearning_train, test_loader, forget_loader)
         forgetting_subset.extend(cfg.unlearn.already_forgotten_classes) 
     
-    plot_features(cfg, new_model, test_loader, pca=pca, unlearned=True, shared_limits=shared_limits)
-    plot_features_3d(cfg, new_model, test_loader, pca, True)
+    if is_main_process():
+        plot_features(cfg, new_model, test_loader, pca=pca, unlearned=True, shared_limits=shared_limits)
+        plot_features_3d(cfg, new_model, test_loader, pca, True)
     
-    # Save new model
+    # Save new model, on rank 0 only
     os.makedirs(os.path.join(cfg.currentDir, cfg.train.save_path), exist_ok=True)
-    if cfg.unlearning_method == 'ssd':
-        torch.save(new_model.state_dict(), os.path.join(cfg.currentDir, cfg.train.save_path, cfg.dataset.name + '_forgetting_set_' + str(forgetting_subset) +'_'+cfg.unlearning_method+'_' + cfg.model + '.pth'))    
-    else:
-        if cfg.unlearning_method != 'icus':
-            torch.save(new_model.state_dict(), os.path.join(cfg.currentDir, cfg.train.save_path, cfg.dataset.name + '_forgetting_set_' + str(cfg.forgetting_set) +'_'+cfg.unlearning_method+'_'+ cfg.model + '.pth'))
-        if cfg.unlearning_method == 'icus' and cfg.unlearn.reconstruct_from_d == False:
-            torch.save(new_model.state_dict(), os.path.join(cfg.currentDir, cfg.train.save_path,"nuovi", cfg.dataset.name + '_forgetting_set_' + str(cfg.forgetting_set) +'_'+cfg.unlearning_method+'_' +cfg.unlearn.aggregation_method+ '_'  + cfg.model + '.pth'))
+    if is_main_process():
+        if cfg.unlearning_method == 'ssd':
+            torch.save(new_model.state_dict(), os.path.join(cfg.currentDir, cfg.train.save_path, cfg.dataset.name + '_forgetting_set_' + str(forgetting_subset) +'_'+cfg.unlearning_method+'_' + cfg.model + '.pth'))    
+        else:
+            if cfg.unlearning_method != 'icus':
+                torch.save(new_model.state_dict(), os.path.join(cfg.currentDir, cfg.train.save_path, cfg.dataset.name + '_forgetting_set_' + str(cfg.forgetting_set) +'_'+cfg.unlearning_method+'_'+ cfg.model + '.pth'))
+            if cfg.unlearning_method == 'icus' and cfg.unlearn.reconstruct_from_d == False:
+                torch.save(new_model.state_dict(), os.path.join(cfg.currentDir, cfg.train.save_path,"nuovi", cfg.dataset.name + '_forgetting_set_' + str(cfg.forgetting_set) +'_'+cfg.unlearning_method+'_' +cfg.unlearn.aggregation_method+ '_'  + cfg.model + '.pth'))
     
     # log metrics
     metrics = compute_metrics(new_model, test_loader, num_classes, forgetting_subset)
@@ -133,7 +138,7 @@ def main(cfg):
             "step": 0
         })
 
-    if cfg.unlearn.update_json == True:
+    if cfg.unlearn.update_json == True and is_main_process():
         with open("src/metrics/metrics.json", "r") as file:
             data = json.load(file)
         done = add_case(data, cfg.unlearning_method, str(cfg.forgetting_set), metrics['accuracy_retaining'], metrics['accuracy_forgetting'])
@@ -142,5 +147,10 @@ def main(cfg):
         if not done:
             print("Failed to add/update json")
 
+@hydra.main(config_path='config', config_name='config', version_base=None)
+def main(cfg):
+    launch(run, cfg)
+
+
 if __name__ == '__main__':
     main()